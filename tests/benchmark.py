@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Measures the time transcode2H264.py spends per file outside of the tools it runs, with the stub tools of tests/stubs,
+and the speed of its subtitle conversion.
+
+Usage: python3 tests/benchmark.py [batch size...]
+
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import harness
+import transcode2H264
+
+DEFAULT_BATCH_SIZES=[1, 10, 50]
+SUBTITLE_SIZES=[1, 8, 32] # MB
+ASS_HEADER='[Script Info]\nScriptType: v4.00+\n\n[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n'
+ASS_DIALOGUES=['Dialogue: 0,{0},{1},Default,,0,0,0,,{{\\i1}}Línea número {2:d},{{\\i0}} con comas, y etiquetas.\\NSegunda línea.\n',
+               'Dialogue: 1,{0},{1},Sign,,0,0,0,,{{\\an7\\pos(0,0)\\p1}}m 0 0 l 100 0 100 100 0 100{{\\p0}}\n']
+
+def run_batch(batch_size, work_dir):
+    """Transcodes batch_size stub videos in one run, and returns the wall time, the time in the tools and the overhead reported by --metrics, per file.
+
+    """
+    for number in range(batch_size):
+        harness.create_video(os.path.join(work_dir, 'video{:04d}.mkv'.format(number)))
+
+    start_time=time.time()
+    process=harness.run_script(['--metrics', 'metrics.json', '.'], work_dir)
+    wall_time=time.time() - start_time
+    if process.returncode:
+        raise RuntimeError(process.stdout)
+
+    with open(os.path.join(work_dir, 'metrics.json'), 'r') as metrics_file:
+        metrics=json.load(metrics_file)
+
+    tool_time=sum(file_metrics['tool_time'] or 0 for file_metrics in metrics['files'].values())
+    return wall_time/batch_size, tool_time/batch_size, metrics['total_overhead']/batch_size
+
+def write_ass(filename, size):
+    """Writes an ASS file of about size bytes, with dialogues and drawings.
+
+    """
+    with open(filename, 'w', encoding='utf-8') as ass_file:
+        ass_file.write(ASS_HEADER)
+        written, number=0, 0
+        while written < size:
+            seconds=number*2
+            start='{:d}:{:02d}:{:02d}.00'.format(seconds//3600, seconds//60 % 60, seconds % 60)
+            end='{:d}:{:02d}:{:02d}.50'.format(seconds//3600, seconds//60 % 60, seconds % 60 + 1)
+            line=ASS_DIALOGUES[number % len(ASS_DIALOGUES)].format(start, end, number)
+            ass_file.write(line)
+            written+=len(line.encode('utf-8'))
+            number+=1
+
+def run_subtitle_conversion(size, work_dir):
+    """Converts an ASS file of size MB to SRT, and returns the speed in MB/s.
+
+    """
+    filename=os.path.join(work_dir, 'subtitle.ass')
+    write_ass(filename, size*1024*1024)
+    start_time=time.time()
+    transcode2H264.ass2srt(filename)
+    return size/(time.time() - start_time)
+
+def main(batch_sizes):
+    print('{:>6} {:>14} {:>14} {:>17}'.format('files', 'wall/file (s)', 'tools/file (s)', 'overhead/file (s)'))
+    for batch_size in batch_sizes:
+        work_dir=tempfile.mkdtemp()
+        try:
+            wall_time, tool_time, overhead=run_batch(batch_size, work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+        print('{:>6} {:>14.3f} {:>14.3f} {:>17.3f}'.format(batch_size, wall_time, tool_time, overhead))
+
+    print()
+    print('{:>6} {:>14}'.format('MB', 'ass2srt MB/s'))
+    for size in SUBTITLE_SIZES:
+        work_dir=tempfile.mkdtemp()
+        try:
+            speed=run_subtitle_conversion(size, work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+        print('{:>6} {:>14.1f}'.format(size, speed))
+
+if __name__ == '__main__':
+    main([int(batch_size) for batch_size in sys.argv[1:]] or DEFAULT_BATCH_SIZES)
@@ -0,0 +1,119 @@
+"""Runs transcode2H264.py with the stub tools of tests/stubs, and reads the command lines they got.
+
+"""
+import contextlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from unittest import mock
+
+TESTS_DIR=os.path.dirname(os.path.abspath(__file__))
+REPO_DIR=os.path.dirname(TESTS_DIR)
+SCRIPT=os.path.join(REPO_DIR, 'transcode2H264.py')
+STUBS_DIR=os.path.join(TESTS_DIR, 'stubs')
+DATA_DIR=os.path.join(TESTS_DIR, 'data')
+TMP_NAME_REGEX=re.compile(r'_tmp_[A-Za-z0-9]{10}')
+
+sys.path.insert(0, REPO_DIR)
+
+import transcode2H264
+
+def get_environment(work_dir, **variables):
+    """Returns the environment running the stub tools, logging to work_dir and with the cache inside it.
+    
+    """
+    environment=dict(os.environ, XDG_CACHE_HOME=os.path.join(work_dir, 'cache'), STUB_LOG=os.path.join(work_dir, 'stub.log'))
+    for tool in ['ffmpeg', 'ffprobe', 'mkvmerge', 'mkvextract']:
+        environment[tool.upper()]=os.path.join(STUBS_DIR, tool)
+        
+    environment.update(variables)
+    return environment
+
+@contextlib.contextmanager
+def stub_tools(work_dir, **variables):
+    """Makes transcode2H264, used as a module, run the stub tools with the environment of get_environment().
+    
+    """
+    environment=get_environment(work_dir, **variables)
+    with mock.patch.dict(os.environ, environment), mock.patch.dict(transcode2H264.TOOLS, dict((tool, environment[tool.upper()]) for tool in transcode2H264.TOOLS)):
+        yield
+
+def run_script(args, work_dir, **variables):
+    """Runs the script in work_dir with the stub tools, returns the completed process.
+    
+    """
+    return subprocess.run([sys.executable, SCRIPT] + args, cwd=work_dir, env=get_environment(work_dir, **variables), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+def start_script(args, work_dir, **variables):
+    """Starts the script in work_dir with the stub tools, in its own process group, returns the running process.
+    
+    """
+    return subprocess.Popen([sys.executable, SCRIPT] + args, cwd=work_dir, env=get_environment(work_dir, **variables), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, start_new_session=True)
+
+def wait_for_tool(work_dir, tool, count=1, timeout=30):
+    """Waits until the script has run tool count times, as logged by the stubs.
+    
+    """
+    deadline=time.time() + timeout
+    while sum(1 for logged_tool, args in read_log(work_dir) if logged_tool == tool) < count:
+        if time.time() > deadline:
+            raise TimeoutError('{} was not run {:d} times'.format(tool, count))
+        
+        time.sleep(0.05)
+
+def get_pids(work_dir, tool):
+    """Returns the process ids of the runs of tool logged by the stubs.
+    
+    """
+    pids=[]
+    with open(os.path.join(work_dir, 'stub.log'), 'r') as log_file:
+        for line in log_file:
+            entry=json.loads(line)
+            if entry['tool'] == tool:
+                pids.append(entry['pid'])
+                
+    return pids
+
+def is_running(pid):
+    """Tells if the process pid is still running (and not a zombie).
+    
+    """
+    try:
+        with open('/proc/{:d}/stat'.format(pid), 'r') as stat_file:
+            return stat_file.read().rsplit(')', 1)[1].split()[0] != 'Z'
+        
+    except FileNotFoundError:
+        return False
+
+def read_log(work_dir, normalize=True):
+    """Returns the (tool, arguments) run by the script, with the random part of temporary names replaced by '*'.
+    
+    """
+    commands=[]
+    log_filename=os.path.join(work_dir, 'stub.log')
+    if os.path.isfile(log_filename):
+        with open(log_filename, 'r') as log_file:
+            for line in log_file:
+                entry=json.loads(line)
+                args=entry['args']
+                if normalize:
+                    args=[TMP_NAME_REGEX.sub('_tmp_*', arg) for arg in args]
+                    
+                commands.append((entry['tool'], args))
+                
+    return commands
+
+def clear_log(work_dir):
+    log_filename=os.path.join(work_dir, 'stub.log')
+    if os.path.isfile(log_filename):
+        os.remove(log_filename)
+
+def create_video(filename, size=1024):
+    """Creates a file the stub ffprobe takes as a video.
+    
+    """
+    with open(filename, 'w') as video_file:
+        video_file.write('video' + 'x' * (size - 5))
@@ -0,0 +1,108 @@
+"""Stand-in for ffmpeg, ffprobe, mkvmerge and mkvextract, replaying outputs recorded from the real tools.
+
+Every run is appended to the file in STUB_LOG, as a JSON line with the tool name, its arguments and its process id.
+The tools named in STUB_FAIL (comma separated) exit with an error without doing anything, and
+the ones named in STUB_HANG never end, as a long encoding, until they are killed.
+"""
+import json
+import os
+import sys
+import time
+
+DATA_DIR=os.environ.get('STUB_DATA', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data'))
+
+def replay(filename, stream):
+    with open(os.path.join(DATA_DIR, filename), 'r', encoding='utf-8') as data_file:
+        stream.write(data_file.read())
+        
+    stream.flush()
+    
+def create(filename, content='stub output\n'):
+    with open(filename, 'w') as out_file:
+        out_file.write(content)
+        
+def is_video(filename):
+    try:
+        with open(filename, 'r', errors='replace') as in_file:
+            return in_file.read(5) == 'video'
+        
+    except OSError:
+        return False
+    
+def ffprobe(args):
+    if '-version' in args:
+        replay('ffprobe_version.txt', sys.stdout)
+        return 0
+    
+    if not is_video(args[-1]):
+        sys.stderr.write('{}: Invalid data found when processing input\n'.format(args[-1]))
+        return 1
+    
+    probe_data='ffprobe_{}.json'.format(os.path.splitext(args[-1])[1][1:]) # As probed from a file of that format, if recorded.
+    replay(probe_data if os.path.isfile(os.path.join(DATA_DIR, probe_data)) else 'ffprobe.json', sys.stdout)
+    return 0
+
+def ffmpeg(args):
+    if '-version' in args:
+        replay('ffmpeg_version.txt', sys.stdout)
+        return 0
+    
+    if '-filters' in args:
+        replay('ffmpeg_filters.txt', sys.stdout)
+        return 0
+    
+    if any('cropdetect' in arg for arg in args):
+        replay('cropdetect.txt', sys.stderr)
+        
+    if any(arg.endswith(']ssim') for arg in args):
+        replay('ssim.txt', sys.stderr)
+        
+    if '-progress' in args:
+        replay('progress.txt', sys.stdout)
+        
+    output=args[-1]
+    if 'segment' in args: # Segments of chunked encoding, output is a printf pattern.
+        for n in range(2):
+            create(output % n)
+            
+    elif output != '-':
+        create(output)
+        
+    return 0
+
+def mkvextract(args):
+    for spec in args[2:]:
+        track_id, separator, filename=spec.partition(':')
+        with open(os.path.join(DATA_DIR, 'subtitle.ass' if filename.endswith('.ass') else 'subtitle.srt'), 'rb') as data_file:
+            data=data_file.read()
+            
+        with open(filename, 'wb') as out_file:
+            out_file.write(data)
+            
+    return 0
+
+def mkvmerge(args):
+    if '--version' in args:
+        replay('mkvmerge_version.txt', sys.stdout)
+        return 0
+    
+    create(args[args.index('-o') + 1])
+    return 0
+
+def main(tool):
+    args=sys.argv[1:]
+    if os.environ.get('STUB_LOG'):
+        with open(os.environ['STUB_LOG'], 'a') as log_file:
+            log_file.write(json.dumps({'tool': tool, 'args': args, 'pid': os.getpid()}) + '\n')
+            
+    if tool in os.environ.get('STUB_FAIL', '').split(','):
+        sys.exit(1)
+        
+    if tool in os.environ.get('STUB_HANG', '').split(','):
+        while True:
+            time.sleep(60)
+            
+    if tool == 'mkvextract':
+        sys.exit(mkvextract(args))
+        
+    sys.exit({'ffmpeg': ffmpeg, 'ffprobe': ffprobe, 'mkvmerge': mkvmerge}.get(tool, lambda args: 0)(args))
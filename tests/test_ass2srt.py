@@ -0,0 +1,79 @@
+"""Checks the conversion of ASS/SSA subtitles to SRT.
+
+"""
+import codecs
+import os
+import shutil
+import tempfile
+import unittest
+
+import harness
+import transcode2H264
+
+HEADER='[Script Info]\nScriptType: v4.00+\n\n[V4+ Styles]\nFormat: Name, Fontname, Fontsize\nStyle: Default,Arial,20\n\n[Events]\n'
+DEFAULT_FORMAT='Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n'
+
+class Ass2SrtTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir=tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+
+    def convert(self, data, encoding='utf-8'):
+        filename=os.path.join(self.work_dir, 'subtitle.ass')
+        with open(filename, 'wb') as ass_file:
+            ass_file.write(data if isinstance(data, bytes) else data.encode(encoding))
+
+        with open(transcode2H264.ass2srt(filename, encoding=encoding), 'r', encoding='utf-8') as srt_file:
+            return srt_file.read()
+
+    def test_default_format(self):
+        srt=self.convert(HEADER + DEFAULT_FORMAT
+                         + 'Dialogue: 0,0:00:01.00,0:00:03.50,Default,,0,0,0,,{\\i1}Hello{\\i0}\\Nworld\n'
+                         + 'Comment: 0,0:00:02.00,0:00:03.00,Default,,0,0,0,,Not shown\n'
+                         + 'Dialogue: 0,1:02:03.04,1:02:05.60,Default,,0,0,0,,Second\\hline\n')
+        self.assertEqual(srt, '1\n00:00:01,000 --> 00:00:03,500\nHello\nworld\n\n2\n01:02:03,040 --> 01:02:05,600\nSecond line\n\n')
+
+    def test_custom_format_order(self):
+        srt=self.convert(HEADER + 'Format: Start, End, Text\n' + 'Dialogue: 0:00:05.10,0:00:06.20,Only three fields\n')
+        self.assertEqual(srt, '1\n00:00:05,100 --> 00:00:06,200\nOnly three fields\n\n')
+        srt=self.convert(HEADER + 'Format: Marked, End, Start, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n'
+                         + 'Dialogue: Marked=0,0:00:09.00,0:00:07.00,Default,,0000,0000,0000,,Reversed times\n')
+        self.assertEqual(srt, '1\n00:00:07,000 --> 00:00:09,000\nReversed times\n\n')
+
+    def test_commas_in_text(self):
+        srt=self.convert(HEADER + DEFAULT_FORMAT + 'Dialogue: 0,0:00:01.00,0:00:02.00,Default,,0,0,0,,Well, yes, no, maybe.\n')
+        self.assertEqual(srt, '1\n00:00:01,000 --> 00:00:02,000\nWell, yes, no, maybe.\n\n')
+
+    def test_drawings_are_skipped(self):
+        srt=self.convert(HEADER + DEFAULT_FORMAT
+                         + 'Dialogue: 0,0:00:01.00,0:00:02.00,Default,,0,0,0,,{\\an7\\pos(0,0)\\p1}m 0 0 l 100 0 100 100 0 100{\\p0}\n'
+                         + 'Dialogue: 0,0:00:02.00,0:00:03.00,Default,,0,0,0,,{\\pos(10,10)}Text\n'
+                         + 'Dialogue: 0,0:00:03.00,0:00:04.00,Default,,0,0,0,,{\\fad(100,100)}\n')
+        self.assertEqual(srt, '1\n00:00:02,000 --> 00:00:03,000\nText\n\n')
+
+    def test_bom_and_crlf(self):
+        data=HEADER + DEFAULT_FORMAT + 'Dialogue: 0,0:00:01.00,0:00:02.00,Default,,0,0,0,,Adiós\n'
+        expected='1\n00:00:01,000 --> 00:00:02,000\nAdiós\n\n'
+        self.assertEqual(self.convert(codecs.BOM_UTF8 + data.encode('utf-8')), expected)
+        self.assertEqual(self.convert(data.replace('\n', '\r\n')), expected)
+        self.assertEqual(self.convert(codecs.BOM_UTF8 + data.replace('\n', '\r\n').encode('utf-8')), expected)
+        self.assertEqual(self.convert(data.replace('\n', '\r\n'), 'utf-16'), expected)
+
+    def test_legacy_charset(self):
+        data=HEADER + DEFAULT_FORMAT + 'Dialogue: 0,0:00:01.00,0:00:02.00,Default,,0,0,0,,Привет\n'
+        self.assertEqual(self.convert(data, 'cp1251'), '1\n00:00:01,000 --> 00:00:02,000\nПривет\n\n')
+
+    def test_recorded_file(self):
+        with open(os.path.join(harness.DATA_DIR, 'subtitle.ass'), 'rb') as ass_file:
+            srt=self.convert(ass_file.read())
+
+        self.assertEqual(srt, '1\n00:00:01,000 --> 00:00:03,500\nHola, mundo\nadiós\n\n2\n00:01:02,250 --> 00:01:04,000\nSegunda línea\n\n')
+
+    def test_times(self):
+        self.assertEqual(transcode2H264.ass_time2srt_time('0:00:01.23'), '00:00:01,230')
+        self.assertEqual(transcode2H264.ass_time2srt_time('10:00:01.5'), '10:00:01,500')
+        self.assertEqual(transcode2H264.ass_time2srt_time(' 0:1:2,345'), '00:01:02,345')
+        self.assertIsNone(transcode2H264.ass_time2srt_time('later'))
+
+if __name__ == '__main__':
+    unittest.main()
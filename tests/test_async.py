@@ -0,0 +1,41 @@
+"""Checks the transcoding of files from an asyncio event loop, with the stub tools.
+
+"""
+import asyncio
+import os
+
+import harness
+import transcode2H264
+from test_commands import ScriptTestCase
+
+class AsyncTranscoderTest(ScriptTestCase):
+    def test_transcode_all(self):
+        harness.create_video(self.path('other.mkv'))
+        with open(self.path('broken.mkv'), 'w') as broken_file:
+            broken_file.write('not a video')
+
+        with harness.stub_tools(self.work_dir), open(os.devnull, 'w') as log:
+            transcoder=transcode2H264.AsyncTranscoder(transcode2H264.TranscodeOptions(), max_jobs=2, log=log)
+            results=asyncio.run(transcoder.transcode_all([self.path('movie.mkv'), self.path('other.mkv'), self.path('broken.mkv')]))
+
+        self.assertEqual([result.output_filename for result in results[:2]], [self.path('movie_h264.mkv'), self.path('other_h264.mkv')])
+        self.assertIsInstance(results[2], transcode2H264.ProbeError)
+        self.assertEqual(self.get_leftovers(), [])
+
+    def test_cancel(self):
+        async def transcode_and_cancel(transcoder):
+            task=asyncio.ensure_future(transcoder.transcode(self.path('movie.mkv')))
+            while not harness.read_log(self.work_dir) or harness.read_log(self.work_dir)[-1][0] != 'ffmpeg':
+                await asyncio.sleep(0.05)
+
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with harness.stub_tools(self.work_dir, STUB_HANG='ffmpeg'), open(os.devnull, 'w') as log:
+            asyncio.run(transcode_and_cancel(transcode2H264.AsyncTranscoder(transcode2H264.TranscodeOptions(), log=log)))
+
+        self.assertFalse(any(harness.is_running(pid) for pid in harness.get_pids(self.work_dir, 'ffmpeg')))
+        self.assertNotIn('mkvmerge', [tool for tool, args in harness.read_log(self.work_dir)]) # Nothing run after cancelling it.
+        self.assertEqual(self.get_leftovers(), [])
+        self.assertFalse(os.path.exists(self.path('movie_h264.mkv')))
@@ -0,0 +1,61 @@
+"""Checks the charset guessed for subtitle files written in several charsets.
+
+"""
+import codecs
+import os
+import shutil
+import tempfile
+import unittest
+
+import harness
+import transcode2H264
+
+SUBTITLE='1\n00:00:01,000 --> 00:00:03,500\n{}\n\n2\n00:00:04,000 --> 00:00:06,000\n{}\n\n'
+TEXTS={
+    'cp1252': ('¿Qué pasó? El niño está aquí, señor.', 'Ça ne fait rien, garçon: à bientôt, où que tu sois.'),
+    'cp1251': ('Привет, как дела? Всё хорошо.', 'Мы пойдём домой завтра вечером.'),
+    'koi8-r': ('Где ты был вчера? Я тебя ждал.', 'Это очень странная история, друг мой.'),
+    'cp1253': ('Καλημέρα, τι κάνεις; Είμαι καλά.', 'Θα πάμε στη θάλασσα αύριο το πρωί.'),
+    }
+
+class DetectCharsetTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir=tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+
+    def write_subtitle(self, name, data):
+        filename=os.path.join(self.work_dir, name)
+        with open(filename, 'wb') as subtitle_file:
+            subtitle_file.write(data)
+
+        return filename
+
+    def test_legacy_charsets(self):
+        for charset, texts in TEXTS.items():
+            with self.subTest(charset=charset):
+                filename=self.write_subtitle(charset + '.srt', SUBTITLE.format(*texts).encode(charset))
+                self.assertEqual(transcode2H264.detect_charset(filename), charset)
+
+    def test_cyrillic_charsets_are_not_confused(self):
+        for charset in ['cp1251', 'koi8-r']:
+            with self.subTest(charset=charset):
+                filename=self.write_subtitle('short_' + charset + '.srt', SUBTITLE.format('Да.', 'Нет, спасибо.').encode(charset))
+                self.assertEqual(transcode2H264.detect_charset(filename), charset)
+
+    def test_unicode(self):
+        text=SUBTITLE.format(*TEXTS['cp1251'])
+        self.assertEqual(transcode2H264.detect_charset(self.write_subtitle('utf8.srt', text.encode('utf-8'))), 'utf-8')
+        self.assertEqual(transcode2H264.detect_charset(self.write_subtitle('utf8_bom.srt', codecs.BOM_UTF8 + text.encode('utf-8'))), 'utf-8')
+        self.assertEqual(transcode2H264.detect_charset(self.write_subtitle('utf16.srt', text.encode('utf-16'))), 'utf-16le')
+        self.assertEqual(transcode2H264.detect_charset(self.write_subtitle('utf16be.srt', codecs.BOM_UTF16_BE + text.encode('utf-16-be'))), 'utf-16be')
+
+    def test_utf8_cut_by_the_sample(self):
+        text='ñ'*transcode2H264.CHARSET_SAMPLE_SIZE # The sample ends in the middle of a character.
+        self.assertEqual(transcode2H264.detect_charset(self.write_subtitle('long.srt', b'a' + text.encode('utf-8'))), 'utf-8')
+
+    def test_ascii_and_binary(self):
+        self.assertEqual(transcode2H264.detect_charset(self.write_subtitle('ascii.srt', SUBTITLE.format('Hello.', 'Bye.').encode('ascii'))), 'us-ascii')
+        self.assertIsNone(transcode2H264.detect_charset(self.write_subtitle('binary.srt', b'\x1a\x45\xdf\xa3\x00\x00\x00\x01')))
+
+if __name__ == '__main__':
+    unittest.main()
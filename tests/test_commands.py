@@ -0,0 +1,232 @@
+"""Checks the command lines run by transcode2H264.py, and its parsing of the tools output, with the stub tools.
+
+"""
+import glob
+import json
+import os
+import shutil
+import signal
+import stat
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import harness
+import transcode2H264
+
+ENCODE_OPTIONS=['-c:v', 'libx264', '-preset', 'medium', '-crf', '23']
+AUDIO_OPTIONS=['-acodec', 'aac', '-ar', '48k', '-ab', '192k', '-strict', 'experimental', '-max_muxing_queue_size', '9999', '-threads', '0']
+
+def replaying_runner(data_filename, commands=None):
+    """Returns a process runner giving the recorded output of data_filename to any command, as stdout or stderr.
+
+    """
+    with open(os.path.join(harness.DATA_DIR, data_filename), 'r') as data_file:
+        data=data_file.read()
+
+    def process_runner(cmd, stdout=None, stderr=None, line_handler=None):
+        if commands is not None:
+            commands.append(cmd)
+
+        if line_handler:
+            for line in data.splitlines(True):
+                line_handler(line)
+
+            return 0, None, None
+
+        return 0, data if stdout == subprocess.PIPE else None, data if stderr == subprocess.PIPE else None
+
+    return process_runner
+
+class ScriptTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir=tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        harness.create_video(self.path('movie.mkv'))
+        shutil.copy(os.path.join(harness.DATA_DIR, 'subtitle.srt'), self.path('movie.srt'))
+
+    def path(self, filename):
+        return os.path.join(self.work_dir, filename)
+
+    def run_script(self, *args, **variables):
+        harness.clear_log(self.work_dir)
+        process=harness.run_script(list(args), self.work_dir, **variables)
+        self.assertEqual(process.returncode, 0, process.stdout)
+        return process.stdout, harness.read_log(self.work_dir)
+
+    def get_leftovers(self):
+        return [filename for filename in os.listdir(self.work_dir) if '_tmp_' in filename]
+
+class CommandLineTest(ScriptTestCase):
+    def test_default_commands(self):
+        output, commands=self.run_script('movie.mkv')
+        self.assertEqual(commands, [
+            ('ffprobe', ['-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', 'movie.mkv']),
+            ('mkvextract', ['tracks', 'movie.mkv', '2:movie_tmp_*.ass', '3:movie_tmp_*.srt']),
+            ('ffmpeg', ['-progress', 'pipe:1', '-nostats', '-i', 'movie.mkv'] + ENCODE_OPTIONS + AUDIO_OPTIONS + ['-sn', '-y', 'movie_tmp_*.mkv']),
+            ('mkvmerge', ['--default-language', 'jpn', '-o', 'movie_h264_tmp_*.mkv', 'movie_tmp_*.mkv',
+                          '--language', '0:spa', '--sub-charset', '0:us-ascii', 'movie.srt',
+                          '--language', '0:spa', '--sub-charset', '0:utf-8', 'movie_tmp_*.ass',
+                          '--language', '0:spa', '--sub-charset', '0:us-ascii', 'movie_tmp_*.srt']),
+            ])
+        self.assertIn('1 file transcoded OK', output)
+        self.assertTrue(os.path.isfile(self.path('movie_h264.mkv')))
+        self.assertEqual(self.get_leftovers(), [])
+
+    def test_probe_is_cached(self):
+        self.run_script('movie.mkv')
+        output, commands=self.run_script('movie.mkv')
+        self.assertNotIn('ffprobe', [tool for tool, args in commands])
+        self.assertTrue(os.path.isfile(self.path('movie__h264.mkv')))
+
+    def test_failed_probe_is_not_cached(self):
+        output, commands=self.run_script('movie.mkv', STUB_FAIL='ffprobe')
+        self.assertIn('not a proper video file', output)
+        output, commands=self.run_script('movie.mkv')
+        self.assertIn('1 file transcoded OK', output)
+
+    def test_auto_crop(self):
+        output, commands=self.run_script('-c', 'movie.mkv')
+        encode_args=[args for tool, args in commands if tool == 'ffmpeg' and '-progress' in args][0]
+        self.assertIn('crop=1920:800:0:140', encode_args) # The most common value of the recorded cropdetect output.
+        crop_args=[args for tool, args in commands if tool == 'ffmpeg' and '-skip_frame' in args][0]
+        self.assertTrue(crop_args[crop_args.index('-vf') + 1].endswith('cropdetect=reset=1'))
+
+    def test_direct_mux_with_srt_conversion(self):
+        shutil.copy(os.path.join(harness.DATA_DIR, 'subtitle.ass'), self.path('movie.ass'))
+        os.remove(self.path('movie.srt'))
+        output, commands=self.run_script('-d', '--srt', 'movie.mkv')
+        self.assertEqual([tool for tool, args in commands], ['ffprobe', 'ffmpeg'])
+        self.assertEqual(commands[1][1], ['-progress', 'pipe:1', '-nostats', '-i', 'movie.mkv', '-sub_charenc', 'utf-8', '-i', 'movie_tmp_*.srt',
+                                          '-map', '0:V:0', '-map', '0:a:0?', '-map', '0:s?', '-c:s', 'copy', '-c:s:0', 'srt', '-map', '1:0', '-c:s:2', 'srt']
+                                         + ENCODE_OPTIONS + AUDIO_OPTIONS + ['-metadata:s:s:1', 'language=spa', '-metadata:s:s:2', 'language=spa', '-f', 'matroska', '-y', 'movie_h264_tmp_*.mkv'])
+        self.assertTrue(os.path.isfile(self.path('movie.ass'))) # External files are kept.
+        self.assertEqual(self.get_leftovers(), [])
+
+    def test_direct_mux_of_mp4(self):
+        os.rename(self.path('movie.mkv'), self.path('movie.mp4'))
+        output, commands=self.run_script('-d', 'movie.mp4')
+        self.assertEqual([tool for tool, args in commands], ['ffprobe', 'ffmpeg'])
+        self.assertEqual(commands[1][1][:17], ['-progress', 'pipe:1', '-nostats', '-i', 'movie.mp4', '-sub_charenc', 'us-ascii', '-i', 'movie.srt',
+                                               '-map', '0:V:0', '-map', '0:a:0?', '-map', '1:0', '-c:s:0', 'srt']) # No mov_text stream copied.
+        self.assertIn('1 file transcoded OK', output)
+
+    def test_srt_conversion_of_a_binary_subtitle(self):
+        with open(os.path.join(harness.DATA_DIR, 'subtitle.ass'), 'r', encoding='utf-8') as ass_file:
+            data=ass_file.read().encode('utf-16-le') # No BOM, so it is not taken as text.
+
+        with open(self.path('movie.ass'), 'wb') as ass_file:
+            ass_file.write(data)
+
+        os.remove(self.path('movie.srt'))
+        output, commands=self.run_script('--srt', 'movie.mkv')
+        self.assertIn('1 file transcoded OK', output)
+        mkvmerge_args=[args for tool, args in commands if tool == 'mkvmerge'][0]
+        self.assertEqual(mkvmerge_args[mkvmerge_args.index('movie.ass') - 2:mkvmerge_args.index('movie.ass') + 1], ['--language', '0:spa', 'movie.ass'])
+
+    def test_chunks(self):
+        output, commands=self.run_script('-k', '2', 'movie.mkv')
+        ffmpeg_outputs=[args[-1] for tool, args in commands if tool == 'ffmpeg']
+        self.assertEqual(sorted(ffmpeg_outputs[1:-1]), ['movie_tmp_*_audio.mka', 'movie_tmp_*_part000_enc.mkv', 'movie_tmp_*_part001_enc.mkv'])
+        self.assertEqual(ffmpeg_outputs[-1], 'movie_tmp_*.mkv')
+        self.assertEqual(self.get_leftovers(), [])
+
+    def test_chunks_of_a_name_with_percent(self):
+        harness.create_video(self.path('100% Wolf.mkv'))
+        output, commands=self.run_script('-k', '2', '100% Wolf.mkv')
+        self.assertIn('1 file transcoded OK', output)
+        self.assertEqual([args[-1] for tool, args in commands if tool == 'ffmpeg' and '-segment_time' in args], ['100%% Wolf_tmp_*_part%03d.mkv'])
+        self.assertIn(['-i', '100% Wolf_tmp_*_part001.mkv'], [args[:2] for tool, args in commands if tool == 'ffmpeg'])
+        self.assertTrue(os.path.isfile(self.path('100% Wolf_h264.mkv')))
+        self.assertEqual(self.get_leftovers(), [])
+
+    def test_parallel_jobs_do_not_share_outputs(self):
+        harness.create_video(self.path('movie.mp4'))
+        output, commands=self.run_script('-j', '2', 'movie.mkv', 'movie.mp4')
+        self.assertIn('2 files transcoded OK', output)
+        self.assertEqual(sorted(glob.glob(self.path('*_h264.mkv'))), [self.path('movie__h264.mkv'), self.path('movie_h264.mkv')])
+
+    def test_interrupted_run(self):
+        os.mkdir(self.path('input'))
+        harness.create_video(self.path(os.path.join('input', 'a.mkv')))
+        process=harness.start_script(['input'], self.work_dir, STUB_HANG='ffmpeg')
+        try:
+            harness.wait_for_tool(self.work_dir, 'ffmpeg')
+
+        finally:
+            os.killpg(process.pid, signal.SIGKILL) # As the OOM killer would, with no chance to clean.
+            process.communicate()
+
+        placeholder=self.path(os.path.join('input', 'a_h264.mkv'))
+        self.assertEqual(os.path.getsize(placeholder), 0)
+        self.assertEqual(stat.S_IMODE(os.stat(placeholder).st_mode) & 0o111, 0)
+        output, commands=self.run_script('input')
+        self.assertIn('1 file transcoded OK', output)
+        self.assertGreater(os.path.getsize(placeholder), 0)
+        self.assertFalse(os.path.exists(self.path(os.path.join('input', 'a__h264.mkv'))))
+
+    def test_explicit_files_are_always_tried(self):
+        harness.create_video(self.path('clip.mxf'))
+        output, commands=self.run_script('clip.mxf')
+        self.assertIn('1 file transcoded OK', output)
+
+    def test_directory_filters(self):
+        os.mkdir(self.path('input'))
+        for filename in ['a.mkv', 'b.mxf', 'c.mkv', 'c_h264.mkv']:
+            harness.create_video(self.path(os.path.join('input', filename)))
+
+        output, commands=self.run_script('input')
+        self.assertEqual([args[-1] for tool, args in commands if tool == 'ffprobe'], [os.path.join('input', 'a.mkv')])
+
+    def test_metrics(self):
+        output, commands=self.run_script('--metrics', 'metrics.json', 'movie.mkv')
+        with open(self.path('metrics.json'), 'r') as metrics_file:
+            metrics=json.load(metrics_file)
+
+        file_metrics=metrics['files']['movie.mkv']
+        self.assertEqual(file_metrics['encode_stats']['out_time'], '00:22:05.493000')
+        self.assertGreater(file_metrics['tool_time'], 0)
+        self.assertGreaterEqual(metrics['total_overhead'], 0)
+        self.assertTrue(metrics['tool_versions']['ffmpeg'].startswith('ffmpeg version 6.1.1'))
+
+class ParsingTest(unittest.TestCase):
+    def test_media_info(self):
+        with open(os.path.join(harness.DATA_DIR, 'ffprobe.json'), 'r') as probe_file:
+            media_info=transcode2H264.MediaInfo(json.load(probe_file))
+
+        self.assertTrue(media_info.has_video())
+        self.assertTrue(media_info.is_matroska())
+        self.assertEqual(media_info.get_duration(), 1325)
+        self.assertEqual(media_info.get_video_codec(), 'h264')
+        self.assertEqual(media_info.get_video_size(), (1920, 1080))
+        self.assertEqual(media_info.get_audio_codecs(), ['ac3'])
+        self.assertEqual(media_info.get_audio_language(), 'jpn')
+        self.assertEqual(media_info.get_subtitle_tracks(), [(2, 'ass', 'spa'), (3, 'subrip', None)])
+
+    def test_not_a_video(self):
+        self.assertFalse(transcode2H264.MediaInfo({}).has_video())
+        self.assertIsNone(transcode2H264.MediaInfo({}).get_duration())
+
+    def test_progress(self):
+        output=open(os.devnull, 'w')
+        self.addCleanup(output.close)
+        commands=[]
+        exit_code, stats=transcode2H264.run_ffmpeg_with_progress(['ffmpeg', '-i', 'movie.mkv', 'out.mkv'], 1325, 'movie.mkv', output, replaying_runner('progress.txt', commands))
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(commands, [['ffmpeg', '-progress', 'pipe:1', '-nostats', '-i', 'movie.mkv', 'out.mkv']])
+        self.assertEqual(stats['out_time_us'], '1325493000')
+        self.assertEqual(stats['speed'], '2.00x')
+
+    def test_quality(self):
+        quality=transcode2H264.measure_quality('sample.mkv', 'movie.mkv', 10, 5, '1920:800:0:140', 'ssim', replaying_runner('ssim.txt'))
+        self.assertAlmostEqual(quality, 0.988915)
+
+    def test_filters(self):
+        self.assertTrue(transcode2H264.CROP_REGEX.search('crop=1920:800:0:140'))
+        with mock.patch.dict(transcode2H264.TOOLS, ffmpeg=os.path.join(harness.STUBS_DIR, 'ffmpeg')):
+            self.assertTrue(transcode2H264.has_ffmpeg_filter('libvmaf'))
+            self.assertFalse(transcode2H264.has_ffmpeg_filter('libplacebo'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""Checks the job queue shared by several workers, in this process and running the script in other ones.
+
+"""
+import os
+import sqlite3
+import threading
+import time
+from unittest import mock
+
+import harness
+import transcode2H264
+from test_commands import ScriptTestCase
+
+class JobQueueTest(ScriptTestCase):
+    def setUp(self):
+        super().setUp()
+        self.job_queue=transcode2H264.JobQueue(self.path('queue.db'))
+        self.movie=self.path('movie.mkv')
+
+    def test_claim(self):
+        self.assertTrue(self.job_queue.put(self.movie, transcode2H264.TranscodeOptions(crf=20)))
+        filename, options=self.job_queue.claim('worker1')
+        self.assertEqual((filename, options.crf), (self.movie, 20))
+        self.assertIsNone(self.job_queue.claim('worker2')) # Held by worker1.
+        self.assertTrue(self.job_queue.renew(self.movie, 'worker1'))
+        self.assertFalse(self.job_queue.renew(self.movie, 'worker2'))
+        self.assertTrue(self.job_queue.has_unfinished())
+        self.job_queue.finish(self.movie, 'worker1', 'done', {'output': 'movie_h264.mkv'})
+        self.assertEqual(self.job_queue.get_states(), [(self.movie, 'done', {'output': 'movie_h264.mkv'})])
+        self.assertFalse(self.job_queue.has_unfinished())
+        self.assertFalse(self.job_queue.put(self.movie, transcode2H264.TranscodeOptions())) # Already transcoded.
+
+    def test_failed_files_are_queued_again(self):
+        self.job_queue.put(self.movie, transcode2H264.TranscodeOptions())
+        self.job_queue.claim('worker1')
+        self.job_queue.finish(self.movie, 'worker1', 'failed', {'error': 'ffmpeg failed'})
+        self.assertIsNone(self.job_queue.claim('worker1'))
+        self.assertTrue(self.job_queue.put(self.movie, transcode2H264.TranscodeOptions()))
+        self.assertEqual(self.job_queue.claim('worker2')[0], self.movie)
+
+    def test_expired_lease(self):
+        self.job_queue.put(self.movie, transcode2H264.TranscodeOptions())
+        with mock.patch.object(transcode2H264, 'LEASE_TIME', -1): # Expired as soon as claimed, as if the worker crashed.
+            self.job_queue.claim('worker1')
+            self.assertEqual(self.job_queue.claim('worker2')[0], self.movie)
+
+        self.assertFalse(self.job_queue.renew(self.movie, 'worker1'))
+        self.job_queue.finish(self.movie, 'worker1', 'failed', {'error': 'late'}) # Ignored, not its file anymore.
+        self.assertEqual(self.job_queue.get_states(), [(self.movie, 'running', None)])
+        self.assertTrue(self.job_queue.renew(self.movie, 'worker2'))
+
+    def test_max_attempts(self):
+        self.job_queue.put(self.movie, transcode2H264.TranscodeOptions())
+        with mock.patch.object(transcode2H264, 'LEASE_TIME', -1):
+            for attempt in range(transcode2H264.QUEUE_MAX_ATTEMPTS):
+                self.assertEqual(self.job_queue.claim('worker{:d}'.format(attempt))[0], self.movie)
+
+            self.assertIsNone(self.job_queue.claim('worker'))
+
+        [(path, state, result)]=self.job_queue.get_states()
+        self.assertEqual(state, 'failed')
+        self.assertIn(str(transcode2H264.QUEUE_MAX_ATTEMPTS), result['error'])
+
+class WorkerTest(ScriptTestCase):
+    def test_lost_lease_stops_the_file(self):
+        job_queue=transcode2H264.JobQueue(self.path('queue.db'))
+        movie=self.path('movie.mkv')
+        job_queue.put(movie, transcode2H264.TranscodeOptions())
+        reporter=transcode2H264.Reporter()
+        with harness.stub_tools(self.work_dir, STUB_HANG='ffmpeg'), mock.patch.object(transcode2H264, 'LEASE_TIME', 0.4), mock.patch.object(transcode2H264, 'QUEUE_POLL_INTERVAL', 0.05):
+            worker=threading.Thread(target=transcode2H264.run_worker, args=(job_queue, 1, 0, None, reporter))
+            worker.start()
+            harness.wait_for_tool(self.work_dir, 'ffmpeg')
+            with sqlite3.connect(self.path('queue.db')) as connection: # As another worker would, after the lease expired.
+                connection.execute("UPDATE jobs SET worker = 'thief', lease_expires = ?", (time.time() + 60,))
+
+            deadline=time.time() + 10
+            while any(harness.is_running(pid) for pid in harness.get_pids(self.work_dir, 'ffmpeg')) and time.time() < deadline:
+                time.sleep(0.05)
+
+            self.assertFalse(any(harness.is_running(pid) for pid in harness.get_pids(self.work_dir, 'ffmpeg')))
+            job_queue.finish(movie, 'thief', 'done', {'output': 'thief.mkv'})
+            worker.join(10)
+
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(job_queue.get_states(), [(movie, 'done', {'output': 'thief.mkv'})]) # Nothing recorded by the first worker.
+        self.assertEqual(self.get_leftovers(), [])
+
+    def test_several_workers(self):
+        movies=['movie{:d}.mkv'.format(number) for number in range(4)]
+        for movie in movies:
+            harness.create_video(self.path(movie))
+
+        coordinator=harness.start_script(['--queue', 'queue.db'] + movies, self.work_dir)
+        workers=[harness.start_script(['--worker', 'queue.db'], self.work_dir) for n in range(2)]
+        outputs=[process.communicate(timeout=60)[0] for process in [coordinator] + workers]
+        for process, output in zip([coordinator] + workers, outputs):
+            self.assertEqual(process.returncode, 0, output)
+
+        self.assertIn('4 files transcoded OK', outputs[0])
+        encoded=[args[args.index('-i') + 1] for tool, args in harness.read_log(self.work_dir) if tool == 'ffmpeg']
+        self.assertEqual(sorted(encoded), [self.path(movie) for movie in movies]) # Each one only once.
+        for movie in movies:
+            self.assertTrue(os.path.isfile(self.path(movie.replace('.mkv', '_h264.mkv'))))
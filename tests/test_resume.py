@@ -0,0 +1,90 @@
+"""Checks how transcode2H264.py resumes interrupted work, with the stub tools.
+
+"""
+import json
+import os
+import signal
+
+import harness
+import transcode2H264
+from test_commands import ScriptTestCase
+
+class JournalTest(ScriptTestCase):
+    def read_journal(self):
+        with open(self.path('journal.jsonl'), 'r') as journal_file:
+            return [json.loads(line) for line in journal_file]
+
+    def interrupt(self, tool):
+        """Kills a run with the journal while tool is running, as the OOM killer would.
+        
+        """
+        process=harness.start_script(['--journal', 'journal.jsonl', 'movie.mkv'], self.work_dir, STUB_HANG=tool)
+        try:
+            harness.wait_for_tool(self.work_dir, tool)
+            
+        finally:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.communicate()
+
+    def test_resume_after_encoding(self):
+        self.interrupt('mkvmerge')
+        self.assertEqual(self.read_journal()[-1]['stage'], 'muxing')
+        output, commands=self.run_script('--journal', 'journal.jsonl', 'movie.mkv')
+        self.assertNotIn('ffmpeg', [tool for tool, args in commands]) # The encoded file is taken.
+        self.assertEqual([tool for tool, args in commands], ['mkvextract', 'mkvmerge'])
+        self.assertEqual(self.read_journal()[-1]['stage'], 'done')
+        self.assertGreater(os.path.getsize(self.path('movie_h264.mkv')), 0)
+        self.assertEqual(self.get_leftovers(), [])
+
+    def test_restart_while_encoding(self):
+        self.interrupt('ffmpeg')
+        self.assertEqual(self.read_journal()[-1]['stage'], 'encoding')
+        self.assertNotEqual(self.get_leftovers(), []) # Extracted subtitles.
+        output, commands=self.run_script('--journal', 'journal.jsonl', 'movie.mkv')
+        self.assertIn('Removing temporary file', output)
+        self.assertEqual([tool for tool, args in commands], ['mkvextract', 'ffmpeg', 'mkvmerge'])
+        self.assertTrue(os.path.isfile(self.path('movie_h264.mkv')))
+        self.assertFalse(os.path.exists(self.path('movie__h264.mkv')))
+        self.assertEqual(self.get_leftovers(), [])
+        output, commands=self.run_script('--journal', 'journal.jsonl', 'movie.mkv')
+        self.assertIn('was already transcoded', output)
+        self.assertEqual(commands, [])
+
+    def test_replace_original(self):
+        output, commands=self.run_script('--journal', 'journal.jsonl', '-r', 'movie.mkv')
+        self.assertFalse(os.path.exists(self.path('movie.mkv')))
+        self.assertEqual(self.read_journal()[-1]['stage'], 'done') # Recorded before deleting it.
+        output, commands=self.run_script('--journal', 'journal.jsonl', '-r', 'movie.mkv')
+        self.assertIn('was already transcoded', output)
+        self.assertGreater(os.path.getsize(self.path('movie_h264.mkv')), 0)
+
+    def test_output_is_kept_without_input(self):
+        output=self.path('movie_h264.mkv')
+        harness.create_video(output)
+        os.remove(self.path('movie.mkv'))
+        entry={'path': self.path('movie.mkv'), 'stage': 'muxing', 'output': output, 'partial_output': self.path('movie_h264_tmp_0123456789.mkv')}
+        self.assertIsNone(transcode2H264.clean_journal_leftovers(entry))
+        self.assertTrue(os.path.isfile(output))
+
+    def test_leftovers_are_removed(self):
+        ffmpeg_output=self.path('movie_tmp_0123456789.mkv')
+        for filename in [ffmpeg_output, self.path('movie_tmp_0123456789_part000.mkv'), self.path('movie_h264.mkv'), self.path('movie_h264_tmp_9876543210.mkv')]:
+            harness.create_video(filename)
+
+        entry={'path': self.path('movie.mkv'), 'stage': 'encoding', 'tmp_files': [ffmpeg_output], 'ffmpeg_output': ffmpeg_output, 'output': self.path('movie_h264.mkv'), 'partial_output': self.path('movie_h264_tmp_9876543210.mkv')}
+        self.assertIsNone(transcode2H264.clean_journal_leftovers(entry))
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['movie.mkv', 'movie.srt'])
+
+    def test_encoded_output_is_resumed(self):
+        ffmpeg_output=self.path('movie_tmp_0123456789.mkv')
+        harness.create_video(ffmpeg_output)
+        entry={'path': self.path('movie.mkv'), 'stage': 'encoded', 'ffmpeg_output': ffmpeg_output}
+        self.assertEqual(transcode2H264.clean_journal_leftovers(entry), ffmpeg_output)
+        self.assertTrue(os.path.isfile(ffmpeg_output))
+
+    def test_cut_line_is_ignored(self):
+        with open(self.path('journal.jsonl'), 'w') as journal_file:
+            journal_file.write(json.dumps({'path': self.path('movie.mkv'), 'stage': 'done'}) + '\n{"path": "')
+
+        self.assertEqual(transcode2H264.Journal(self.path('journal.jsonl')).get(self.path('movie.mkv'))['stage'], 'done')
+        self.assertEqual(transcode2H264.read_jsonl(self.path('missing.jsonl')), [])
@@ -13,6 +13,7 @@
 ##
 
 ## Importing modules
+## Those only needed by some options (asyncio, sqlite3, ctypes...) are imported where used, as they take longer to import than the rest together.
 import sys
 import os
 import time
@@ -20,13 +21,32 @@ import random
 import subprocess
 import gettext
 import string
+import threading
+import queue
+import functools
+import collections
+import re
+import glob
+import codecs
+import math
+import struct
+import fcntl
+import json
+import shlex
+import contextlib
+import shutil
 
 ## Setting internationalization
 localedir = os.path.join(os.path.abspath(os.path.dirname(os.path.realpath(__file__))), 'locale')
 
-translate = gettext.translation('transcode2H264', localedir, fallback=True)
+translate = None # Loaded when first needed, not to slow down importing this module.
 
-_ = translate.gettext
+def _(text):
+    global translate
+    if translate is None:
+        translate = gettext.translation('transcode2H264', localedir, fallback=True)
+        
+    return translate.gettext(text)
 
 def i18n_text_argparse(text):
     text = text.replace("usage", _("usage"))
@@ -46,23 +66,82 @@ def i18n_text_argparse(text):
     text = text.replace("expected one argument",_("expected one argument"))
     return text
 
-gettext.gettext = i18n_text_argparse
-
-import argparse ## Need to be imported after the previous declarations, to allow argparse text be translated.
 
+CORES_PER_JOB=8 # libx264 does not scale much further than this.
+STAGES=['probe', 'extract', 'srt', 'crop', 'sample', 'encode', 'mux']
+TOOLS=dict((tool, os.environ.get(tool.upper(), tool)) for tool in ['ffmpeg', 'ffprobe', 'mkvmerge', 'mkvextract']) # The FFMPEG... environment variables allow to use other binaries, as stubs replaying recorded outputs.
+PROGRESS_INTERVAL=60 # Seconds between progress lines, when not writing to a terminal.
+ASS_DEFAULT_EVENT_FORMAT=['layer', 'start', 'end', 'style', 'name', 'marginl', 'marginr', 'marginv', 'effect', 'text']
+ASS_TIME_REGEX=re.compile(r'\s*(\d+):(\d{1,2}):(\d{1,2})[.,](\d{1,3})')
+ASS_TAG_REGEX=re.compile(r'\{[^}]*\}')
+ASS_DRAWING_REGEX=re.compile(r'\{[^}]*\\p[1-9]')
+CHARSET_SAMPLE_SIZE=64*1024 # Enough bytes of a subtitle file to guess its charset.
+CHARSET_BOMS=[(codecs.BOM_UTF32_LE, 'utf-32le'), (codecs.BOM_UTF32_BE, 'utf-32be'), (codecs.BOM_UTF8, 'utf-8'), (codecs.BOM_UTF16_LE, 'utf-16le'), (codecs.BOM_UTF16_BE, 'utf-16be')] # UTF-32 first, its LE BOM starts as the UTF-16 one.
+LEGACY_CHARSETS=['cp1252', 'cp1251', 'koi8-r', 'cp1253'] # Western European, Cyrillic and Greek.
+WORD_REGEX=re.compile(r'[^\W\d_]+')
+charset_cache={} # Charsets already detected, by (path, size, modification time).
+charset_cache_lock=threading.Lock()
+AUTO_CRF_SAMPLES=3 # Samples encoded to choose the CRF of each file...
+AUTO_CRF_SAMPLE_DURATION=10 # ...and their length in seconds.
+AUTO_CRF_STEPS=5 # Maximum number of CRF values tried to reach a target quality.
+QUALITY_REGEXES={'ssim': re.compile(r'SSIM .*All:([\d.]+)'), 'vmaf': re.compile(r'VMAF score[:=]\s*([\d.]+)')}
+QUALITY_FILTERS={'ssim': 'ssim', 'vmaf': 'libvmaf'}
+VIDEO_EXTENSIONS=['.mkv', '.mp4', '.m4v', '.avi', '.mov', '.wmv', '.flv', '.webm', '.mpg', '.mpeg', '.ts', '.m2ts', '.mts', '.vob', '.ogv', '.3gp', '.divx', '.rmvb']
+QUICK_HASH_BLOCK_SIZE=1024*1024 # Bytes read from the beginning and the end of a file to tell duplicates.
+WATCH_POLL_INTERVAL=10 # Seconds between directory scans when inotify is not available.
+INOTIFY_CLOSE_WRITE=0x00000008
+INOTIFY_MOVED_TO=0x00000080
+INOTIFY_CREATE=0x00000100
+INOTIFY_ISDIR=0x40000000
+CROP_REGEX=re.compile(r'crop=(\d+:\d+:\d+:\d+)')
+SPACE_MARGIN=1.1 # Disk space estimations are not exact, ask for some more.
+LEASE_TIME=120 # Seconds a worker holds a file of the job queue without renewing its lease.
+QUEUE_POLL_INTERVAL=5 # Seconds between checks of the job queue, while waiting for other workers.
+QUEUE_MAX_ATTEMPTS=3 # Times a file is given to a worker before considering it failed, in case it kills them.
 
 ## Classes
+class TranscodeError(Exception):
+    """Base class of the errors raised when transcoding a file through the Python API.
+    
+    """
+    
+class ProbeError(TranscodeError):
+    """The input file could not be probed, or it is not a video file.
+    
+    """
+    
+class EncodeError(TranscodeError):
+    """The ffmpeg step failed.
+    
+    """
+    
+class MuxError(TranscodeError):
+    """The mkvmerge step failed.
+    
+    """
+    
 class Video:
     """Contains actual and proposed video information, and can transforme itself.
     
     """
-    def __init__(self,filename):
+    def __init__(self,filename,media_info_cache=None,tmp_dir=None,log=None,process_runner=None):
         self.__in_filename=filename       
+        self.__tmp_dir=tmp_dir # Intermediate files go next to the input file if not set.
+        self.__log=log or sys.stdout # Where progress messages are written.
+        self.__run_process=process_runner or run_process # Runs every external program, see run_process().
+        self.__tools_running=0
+        self.__tools_start_time=None
+        self.__tool_time=0 # Seconds with some external program running, to tell the overhead of the script.
+        self.__tool_lock=threading.Lock() # Chunks run several programs at the same time.
+        self.__media_info_cache=media_info_cache
+        self.__media_info=None
         self.__in_ok=False
         self.__in_duration=None
         self.__avlang = None
-        self.__preset=None        
-        self.__CRF=None
+        self.__encoder=None
+        self.__target_bitrate=None
+        self.__target_quality=None
+        self.__quality_metric=None
         self.__ext_sub_files=[] # Now a list, for more than one sub files. This files are always kept.
         self.__int_sub_files=[] # Now a list, for more than one sub files. This files are removed after the script is completed.
         self.__sub_charsets={} # Now a dictionary, with each subfile as a key.
@@ -72,34 +151,88 @@ class Video:
         self.__slangs = {} # To support multiple subtitles.
         self.__ffmpeg_output_ext='.mkv'
         self.__ffmpeg_output_postfix='_tmp_' + random_string(10)
-        self.__ffmpeg_output=os.path.splitext(self.__in_filename)[0]+self.__ffmpeg_output_postfix+self.__ffmpeg_output_ext
+        self.__ffmpeg_output=self.__get_tmp_root()+self.__ffmpeg_output_postfix+self.__ffmpeg_output_ext
         self.__replace_original=False
         self.__output_postfix=None
         self.__threads=None
         self.__crop_data=None
-        self.__get_input_data()
+        self.__transcoding_options_set=False
+        self.__direct_mux=False
+        self.__smart_copy=False
+        self.__chunks=0
+        self.__crop_samples=20
+        self.__srt=False
+        self.__mkv_output=None
+        self.__mkv_output_complete=False
+        self.__mkv_output_lock=None
+        self.__partial_output=None
+        self.__encoded=False
+        self.__stage_times={}
+        self.__encode_stats={}
+        self.__timed('probe', self.__get_input_data)
+        
+    def __run_tool(self, cmd, *args, **kwargs):
+        """Runs an external program with the process runner, keeping account of the time spent in them.
+        
+        """
+        with self.__tool_lock:
+            if not self.__tools_running:
+                self.__tools_start_time=time.time()
+                
+            self.__tools_running+=1
+            
+        try:
+            return self.__run_process(cmd, *args, **kwargs)
+        
+        finally:
+            with self.__tool_lock:
+                self.__tools_running-=1
+                if not self.__tools_running:
+                    self.__tool_time+=time.time() - self.__tools_start_time
+                    
+    def get_tool_time(self):
+        """Returns the seconds some external program (ffmpeg, mkvmerge...) was running for this video.
+        
+        The rest of the time of all stages is the overhead of the script itself.
+        """
+        return self.__tool_time
+    
+    def __get_tmp_root(self):
+        in_filename_root=os.path.splitext(self.__in_filename)[0]
+        if self.__tmp_dir:
+            return os.path.join(self.__tmp_dir, os.path.basename(in_filename_root))
+        
+        return in_filename_root
+    
+    def __timed(self, stage, function, *args):
+        """Calls function, adding the time it takes to the given stage.
+        
+        """
+        start_time=time.time()
+        try:
+            return function(*args)
+        
+        finally:
+            self.__stage_times[stage]=self.__stage_times.get(stage, 0) + time.time() - start_time
+            
+    def get_stage_times(self):
+        """Returns a dictionary with the seconds spent in each stage (probe, extract, srt, crop, sample, encode, mux).
+        
+        """
+        return dict(self.__stage_times)
+    
+    def get_encode_stats(self):
+        """Returns the last progress values reported by ffmpeg while encoding (fps, speed, bitrate...).
+        
+        """
+        return dict(self.__encode_stats)
 
     def __get_input_data(self):
         if os.path.isfile(self.__in_filename):
-            #cmd_in_file,cmd_output_error_file=os.popen4("ffmpeg -i \"%s\"" % self.__in_filename) # Depecrated in Python3
-            #for line in cmd_output_error_file:   
-            cproc = subprocess.run(["ffmpeg", "-i", self.__in_filename], stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, universal_newlines = True)
-            for line in cproc.stderr.split('\n'):
-                line=line.strip()
-                if ('Video' in line) and ('Stream' in line):
-                    if 'ansi' not in line:
-                        self.__in_ok=True
-                    
-                if ('Audio' in line) and ('Stream' in line):
-                    if '(' in line.split(':')[1]:
-                        self.__avlang = line.split(':')[1].split('(')[1].strip(')')
-                        if "unk" in self.__avlang.lower() or "und" in self.__avlang.lower():
-                            self.__avlang = None
-                    
-                if 'Duration' in line:
-                    duration_string=line.split(',')[0].split()[1]
-                    if not 'N/A' in duration_string:
-                        self.__in_duration=dstring2dint(duration_string)
+            self.__media_info=probe_media(self.__in_filename, self.__media_info_cache, self.__run_tool)
+            self.__in_ok=self.__media_info.has_video()
+            self.__avlang=self.__media_info.get_audio_language()
+            self.__in_duration=self.__media_info.get_duration()
 
     def is_ok(self):
         """Returns true is video file exist and it is actually a video.
@@ -118,22 +251,52 @@ class Video:
                     return
 
     def __try_to_convert_sub_to_srt(self):
-        for sub_file in self.__sub_files:
+        for sub_file in self.__ext_sub_files + self.__int_sub_files:
             subtitle_filename_root,subtitle_filename_ext=os.path.splitext(sub_file)
             
-            if subtitle_filename_ext == '.srt':
+            if subtitle_filename_ext not in ['.ass', '.ssa']:
                 continue
             
-            srt_sub_file=ass2srt(sub_file)
-            if srt_sub_file:
-                self.__int_sub_files.append(srt_sub_file)   
+            self.__find_sub_charset(sub_file)
+            encoding=self.__sub_charsets.get(sub_file)
+            if not encoding:
+                continue # Not text (as UTF-16 without BOM), left as it is.
+            
+            try:
+                codecs.lookup(encoding)
+                
+            except LookupError:
+                encoding='utf-8'
+                
+            srt_sub_file=ass2srt(sub_file, self.__get_tmp_root() + '_tmp_' + random_string(10) + '.srt', encoding)
+            if sub_file in self.__slangs:
+                self.__slangs[srt_sub_file]=self.__slangs[sub_file]
                 
-    def set_transcoding_options(self,preset,crf,replace_original,avlang,slang,postfix,threads,auto_crop):
+            if sub_file in self.__int_sub_files: # A temporary file, not needed anymore.
+                self.__int_sub_files[self.__int_sub_files.index(sub_file)]=srt_sub_file
+                os.remove(sub_file)
+                
+            else:
+                self.__ext_sub_files.remove(sub_file) # Kept, but not muxed.
+                self.__int_sub_files.append(srt_sub_file)
+                
+    def set_transcoding_options(self,preset,crf,replace_original,avlang,slang,postfix,threads,auto_crop,direct_mux=False,smart_copy=False,chunks=0,crop_samples=20,srt=False,encoder='libx264',bitrate=None,two_pass=False,target_bitrate=None,target_quality=None,quality_metric='ssim'):
         if self.__in_ok:
-            self.__preset = preset			
-            self.__CRF = crf
+            self.__encoder = ENCODERS[encoder](preset, crf, bitrate, two_pass)
+            self.__target_bitrate = target_bitrate
+            self.__target_quality = target_quality
+            self.__quality_metric = quality_metric
+            self.__direct_mux = direct_mux
+            self.__smart_copy = smart_copy
+            self.__chunks = chunks
+            self.__crop_samples = crop_samples
+            self.__srt = srt
             self.__find_ext_subtitle()
-            self.__find_int_subtitles()
+            if not direct_mux: # In direct mode ffmpeg takes the internal subtitles straight from the input file.
+                self.__timed('extract', self.__find_int_subtitles)
+                
+            if srt:
+                self.__timed('srt', self.__try_to_convert_sub_to_srt)
 
             self.__replace_original = replace_original            
             self.__default_avlang = avlang
@@ -142,75 +305,498 @@ class Video:
             self.__output_postfix = postfix
             self.__threads = threads
             if auto_crop:
-                sys.stdout.write(_('Finding crop dimensions...'))
-                sys.stdout.flush()
-                self.__get_crop_data()
+                self.__log.write(_('Finding crop dimensions...'))
+                self.__log.flush()
+                self.__timed('crop', self.__get_crop_data)
                 
             self.__transcoding_options_set = True
             
+    def set_options(self, options):
+        """Same as set_transcoding_options, taking them from a TranscodeOptions.
+        
+        """
+        self.set_transcoding_options(options.preset, options.crf, options.replace_original, options.avlang, options.slang, options.postfix, options.threads, options.auto_crop, options.direct_mux, options.smart_copy, options.chunks, options.crop_samples, options.srt, options.encoder, options.bitrate, options.two_pass, options.target_bitrate, options.target_quality, options.quality_metric)
+        
     def __find_int_subtitles(self):
-            n = 1
-            in_filename_root,in_filename_ext=os.path.splitext(self.__in_filename)
-            if in_filename_ext == '.mkv':
-                for line in os.popen("mkvmerge -i \"{}\" -F verbose-text".format(self.__in_filename)):
-                    if 'subtitles' in line:
-                        track_id=int(line.strip().split(":")[0].split()[-1])
-                        sub_type=line.strip().split('(')[1].split(")")[0]
-                        slang = line[line.index("language:"):].split(':')[1].split()[0]
-                        if slang:
-                            if "unk" in slang.lower() or "und" in slang.lower():
-                                    slang = None
-
-                        sub_ext='.srt'
-                        if sub_type in ['ASS','SSA', 'SubStationAlpha']:
-                            sub_ext='.ass'
-                            
-                        #while(os.path.isfile(in_filename_root+"_"+str(n)+sub_ext)):
-                        #    n+=1
-                            
-                        sub_filename = in_filename_root + "_tmp_" + random_string(10) + sub_ext
-                            
-                        os.system("mkvextract tracks \"{}\" {:d}:\"{}\"".format(self.__in_filename, track_id, sub_filename))
+            if self.__media_info.is_matroska():
+                extraction_specs=[]
+                for track_id, sub_codec, slang in self.__media_info.get_subtitle_tracks():
+                    sub_ext='.srt'
+                    if sub_codec in ['ass', 'ssa']:
+                        sub_ext='.ass'
+                        
+                    sub_filename = self.__get_tmp_root() + "_tmp_" + random_string(10) + sub_ext
+                    extraction_specs.append('{:d}:{}'.format(track_id, sub_filename))
+                    self.__int_sub_files.append(sub_filename)
+                    
+                    if slang:
+                        self.__slangs[sub_filename] = slang
                         
-                        self.__int_sub_files.append(sub_filename)
+                if extraction_specs:
+                    # All tracks at once, so the (maybe huge) input file is read only one time.
+                    start_time=time.time()
+                    self.__run_tool(["mkvextract", "tracks", self.__in_filename] + extraction_specs, stdout=subprocess.DEVNULL)
+                    self.__log.write(_('{:d} subtitle track(s) extracted from {} in {}.\n').format(len(extraction_specs), self.__in_filename, print_duration(time.time() - start_time)))
+                    for sub_filename in [sub_filename for sub_filename in self.__int_sub_files if not os.path.isfile(sub_filename)]:
+                        sys.stderr.write(_("WARNING: Subtitle track could not be extracted to {}, ignoring it.\n").format(sub_filename))
+                        self.__int_sub_files.remove(sub_filename)
                         
-                        if slang:
-                            self.__slangs[sub_filename] = slang
+    def __needs_cropping(self):
+        if not self.__crop_data:
+            return False
+        
+        width, height=self.__crop_data.split(':')[:2]
+        return (int(width), int(height)) != self.__media_info.get_video_size()
+    
+    def __can_copy_video(self):
+        return self.__smart_copy and self.__media_info.get_video_codec() == self.__encoder.get_codec_name() and not self.__needs_cropping()
+    
+    def __can_copy_audio(self):
+        audio_codecs=self.__media_info.get_audio_codecs()
+        return self.__smart_copy and audio_codecs and all(codec == 'aac' for codec in audio_codecs)
+    
+    def __get_video_codec_options(self, pass_number=None, passlogfile=None):
+        if self.__can_copy_video():
+            self.__log.write(_('Video stream of {} is already {}, copying it.\n').format(self.__in_filename, self.__encoder.get_codec_name()))
+            return ['-c:v', 'copy']
+            
+        cmd=self.__encoder.get_options(pass_number, passlogfile)
+        if self.__crop_data:
+            cmd+=['-vf', 'crop={}'.format(self.__crop_data)]
+            
+        return cmd
+    
+    def __get_audio_codec_options(self):
+        if self.__can_copy_audio():
+            self.__log.write(_('Audio stream of {} is already AAC, copying it.\n').format(self.__in_filename))
+            return ['-c:a', 'copy']
+            
+        return ['-acodec', 'aac', '-ar', '48k', '-ab', '192k', '-strict', 'experimental']
+    
+    def __get_codec_options(self, pass_number=None, passlogfile=None):
+        return self.__get_video_codec_options(pass_number, passlogfile) + self.__get_audio_codec_options() + ['-max_muxing_queue_size', '9999', '-threads', str(self.__threads)]
+    
+    def __get_passlogfile(self, filename):
+        return os.path.splitext(filename)[0] + '_passlog'
+    
+    def __get_first_pass_command(self, in_filename, passlogfile, threads):
+        return ['ffmpeg', '-i', in_filename, '-map', '0:V:0'] + self.__get_video_codec_options(1, passlogfile) + ['-an', '-sn', '-threads', str(threads), '-f', 'null', '-']
+    
+    def __remove_passlog_files(self, passlogfile):
+        for passlog_file in glob.glob(glob.escape(passlogfile) + '*'):
+            os.remove(passlog_file)
+            
+    def __get_direct_mux_command(self, pass_number=None, passlogfile=None):
+        """ffmpeg command line writing the final MKV file, subtitles and language tags included.
+        
+        """
+        input_cmd=['-i', self.__in_filename]
+        map_cmd=['-map', '0:V:0', '-map', '0:a:0?']
+        metadata_cmd=[]
+        if not self.__avlang:
+            metadata_cmd+=['-metadata:s:a:0', 'language={}'.format(self.__default_avlang)]
+            
+        int_sub_tracks=[]
+        if self.__media_info.is_matroska(): # As the mkvmerge path, others (as MP4 mov_text) can not be copied to Matroska.
+            int_sub_tracks=self.__media_info.get_subtitle_tracks()
+            map_cmd+=['-map', '0:s?', '-c:s', 'copy']
+            
+        for sub_index, (track_id, sub_codec, slang) in enumerate(int_sub_tracks):
+            if self.__srt and sub_codec in ['ass', 'ssa']:
+                map_cmd+=['-c:s:{:d}'.format(sub_index), 'srt']
+                
+            if not slang:
+                metadata_cmd+=['-metadata:s:s:{:d}'.format(sub_index), 'language={}'.format(self.__default_slang)]
+                
+        for input_index, sub_file in enumerate(self.__ext_sub_files + self.__int_sub_files, 1): # Internal ones are only those converted to SRT here.
+            sub_index=len(int_sub_tracks) + input_index - 1
+            self.__find_sub_charset(sub_file)
+            if self.__sub_charsets.get(sub_file) not in [None, 'binary', 'unknown-8bit']:
+                input_cmd+=['-sub_charenc', self.__sub_charsets[sub_file]]
+                
+            input_cmd+=['-i', sub_file]
+            map_cmd+=['-map', '{:d}:0'.format(input_index)]
+            sub_codec='srt'
+            if os.path.splitext(sub_file)[1] in ['.ass', '.ssa']:
+                sub_codec='ass'
+                
+            map_cmd+=['-c:s:{:d}'.format(sub_index), sub_codec]
+            metadata_cmd+=['-metadata:s:s:{:d}'.format(sub_index), 'language={}'.format(self.__slangs.get(sub_file, self.__default_slang))]
+            
+        return ['ffmpeg'] + input_cmd + map_cmd + self.__get_codec_options(pass_number, passlogfile) + metadata_cmd + ['-f', 'matroska', '-y', self.get_partial_output_filename()]
+    
+    def __get_sample_positions(self):
+        sample_duration=min(AUTO_CRF_SAMPLE_DURATION, self.__in_duration / AUTO_CRF_SAMPLES)
+        return [(self.__in_duration * (n + 1) / (AUTO_CRF_SAMPLES + 1) - sample_duration / 2, sample_duration) for n in range(AUTO_CRF_SAMPLES)]
+    
+    def __encode_samples(self, crf):
+        """Encodes short samples of the video with crf, returns their average bitrate in kbit/s and their average quality.
+        
+        Quality is None if there is no target quality. Both values are None if the samples could not be encoded.
+        The CRF of the encoder is only changed while encoding them.
+        """
+        previous_crf=self.__encoder.get_crf()
+        self.__encoder.set_crf(crf)
+        try:
+            return self.__encode_samples_with_crf()
+        
+        finally:
+            self.__encoder.set_crf(previous_crf)
+            
+    def __encode_samples_with_crf(self):
+        bitrates=[]
+        qualities=[]
+        for n, (position, sample_duration) in enumerate(self.__get_sample_positions()):
+            sample_filename=os.path.splitext(self.__ffmpeg_output)[0] + '_sample{:d}.mkv'.format(n)
+            try:
+                cmd=['ffmpeg', '-ss', '{:.3f}'.format(position), '-t', '{:.3f}'.format(sample_duration), '-i', self.__in_filename, '-map', '0:V:0'] + self.__get_video_codec_options() + ['-an', '-sn', '-threads', str(self.__threads), '-y', sample_filename]
+                if self.__run_tool(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)[0]:
+                    return None, None
+                
+                bitrates.append(os.path.getsize(sample_filename) * 8 / 1000 / sample_duration)
+                if self.__target_quality:
+                    quality=measure_quality(sample_filename, self.__in_filename, position, sample_duration, self.__crop_data, self.__quality_metric, self.__run_tool)
+                    if quality is None:
+                        return None, None
+                    
+                    qualities.append(quality)
+                    
+            finally:
+                if os.path.isfile(sample_filename):
+                    os.remove(sample_filename)
+                    
+        if qualities:
+            return sum(bitrates) / len(bitrates), sum(qualities) / len(qualities)
+        
+        return sum(bitrates) / len(bitrates), None
+    
+    def __choose_crf(self):
+        """Sets the CRF reaching the target bitrate or quality, as measured on a few encoded samples.
+        
+        For a target bitrate, the usual rule of the bitrate halving each 6 CRF steps gives a first
+        guess that is corrected with a second measure. For a target quality, the highest CRF
+        reaching it is searched by bisection.
+        """
+        self.__log.write(_('Encoding samples of {} to choose its CRF...\n').format(self.__in_filename))
+        crf=self.__encoder.get_crf()
+        if self.__target_bitrate:
+            bitrate, quality=self.__encode_samples(crf)
+            if not bitrate:
+                return
+            
+            new_crf=int(round(crf + 6 * math.log2(bitrate / self.__target_bitrate)))
+            new_crf=min(max(new_crf, self.__encoder.get_crf_range()[0]), self.__encoder.get_crf_range()[1])
+            if new_crf != crf:
+                new_bitrate, quality=self.__encode_samples(new_crf)
+                if new_bitrate and abs(new_bitrate - bitrate) > 1:
+                    slope=(new_crf - crf) / math.log2(new_bitrate / bitrate)
+                    new_crf=int(round(new_crf + slope * math.log2(self.__target_bitrate / new_bitrate)))
+                    
+            crf=new_crf
+            
+        else:
+            lowest_crf=max(self.__encoder.get_crf_range()[0], self.__encoder.get_default_crf() - 10)
+            highest_crf=min(self.__encoder.get_crf_range()[1], self.__encoder.get_default_crf() + 12)
+            crf=lowest_crf # Best quality tried, if the target is never reached.
+            for step in range(AUTO_CRF_STEPS):
+                if lowest_crf > highest_crf:
+                    break
+                
+                middle_crf=(lowest_crf + highest_crf) // 2
+                bitrate, quality=self.__encode_samples(middle_crf)
+                if quality is None:
+                    return
+                
+                if quality >= self.__target_quality:
+                    crf=middle_crf
+                    lowest_crf=middle_crf + 1
+                    
+                else:
+                    highest_crf=middle_crf - 1
+                    
+        self.__encoder.set_crf(crf)
+        self.__log.write(_('CRF {:d} chosen for {}.\n').format(self.__encoder.get_crf(), self.__in_filename))
+        
+    def __get_chunk_threads(self):
+        threads=self.__threads or os.cpu_count() or 1
+        return max(1, threads // self.__chunks)
+    
+    def __chunked_encode(self):
+        """Splits the video stream at keyframes, encodes the pieces in parallel and joins them, with the audio, into the ffmpeg output.
+        
+        """
+        tmp_root=os.path.splitext(self.__ffmpeg_output)[0]
+        part_pattern=tmp_root.replace('%', '%%') + '_part%03d.mkv' # A printf pattern for the segment muxer.
+        audio_filename=tmp_root + '_audio.mka'
+        list_filename=tmp_root + '_parts.txt'
+        segment_time=max(1, -(-self.__in_duration // self.__chunks))
+        tmp_files=[list_filename, audio_filename]
+        try:
+            cmd=['ffmpeg', '-i', self.__in_filename, '-map', '0:V:0', '-c', 'copy', '-f', 'segment', '-segment_time', str(segment_time), '-reset_timestamps', '1', '-y', part_pattern]
+            self.__log.write('> {}\n'.format(' '.join(shlex.quote(arg) for arg in cmd)))
+            if self.__run_tool(cmd)[0]:
+                return False
+            
+            n=0
+            parts=[]
+            while os.path.isfile('{}_part{:03d}.mkv'.format(tmp_root, n)):
+                parts.append('{}_part{:03d}.mkv'.format(tmp_root, n))
+                n+=1
+                
+            tmp_files+=parts
+            command_lists=[] # Commands of each list are run one after the other, lists in parallel.
+            for part in parts:
+                encoded_part=os.path.splitext(part)[0] + '_enc.mkv'
+                passlogfile=self.__get_passlogfile(part)
+                tmp_files.append(encoded_part)
+                tmp_files.append(passlogfile)
+                commands=[]
+                for pass_number in self.__encoder.get_passes():
+                    if pass_number == 1:
+                        commands.append(self.__get_first_pass_command(part, passlogfile, self.__get_chunk_threads()))
                         
+                    else:
+                        commands.append(['ffmpeg', '-i', part] + self.__get_video_codec_options(pass_number, passlogfile) + ['-an', '-sn', '-threads', str(self.__get_chunk_threads()), '-y', encoded_part])
                         
-    def transcode(self):
+                command_lists.append(commands)
+                
+            has_audio=bool(self.__media_info.get_audio_codecs())
+            if has_audio:
+                command_lists.append([['ffmpeg', '-i', self.__in_filename, '-map', '0:a:0'] + self.__get_audio_codec_options() + ['-vn', '-sn', '-y', audio_filename]])
+                
+            self.__log.write(_('Encoding {:d} chunks of {} in parallel.\n').format(len(parts), self.__in_filename))
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.__chunks + 1) as executor:
+                exit_codes=list(executor.map(functools.partial(run_commands, process_runner=self.__run_tool), command_lists))
+                
+            if any(exit_codes):
+                return False
+            
+            with open(list_filename, 'w') as list_file:
+                for part in parts:
+                    list_file.write("file '{}'\n".format(os.path.abspath(os.path.splitext(part)[0] + '_enc.mkv').replace("'", "'\\''")))
+                    
+            cmd=['ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_filename]
+            if has_audio:
+                cmd+=['-i', audio_filename, '-map', '0:v', '-map', '1:a']
+                
+            cmd+=['-c', 'copy', '-max_muxing_queue_size', '9999', '-y', self.__ffmpeg_output]
+            self.__log.write('> {}\n'.format(' '.join(shlex.quote(arg) for arg in cmd)))
+            return not self.__run_tool(cmd)[0]
+        
+        finally:
+            for tmp_file in tmp_files:
+                if tmp_file.endswith('_passlog'):
+                    self.__remove_passlog_files(tmp_file)
+                    
+                elif os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+    
+    def encode(self):
+        """Runs the ffmpeg step, returns True if it succeeded.
+        
+        In direct mux mode this step already writes the final MKV file.
+        """
+        return self.__timed('encode', self.__encode)
+    
+    def __encode(self):
+        if self.__encoded:
+            self.__log.write(_('File {} was already transcoded to {}, resuming from it.\n').format(self.__in_filename, self.__ffmpeg_output))
+            return True
+        
         if self.__transcoding_options_set:
-            cmd_line='ffmpeg -i \"{}\" -c:v libx264 -preset {} -crf {:d}'.format(self.__in_filename, self.__preset, self.__CRF)
-            if self.__crop_data:
-                cmd_line+=' -vf crop={}'.format(self.__crop_data)
+            if (self.__target_bitrate or self.__target_quality) and self.__in_duration and self.__encoder.uses_crf() and not self.__can_copy_video():
+                self.__timed('sample', self.__choose_crf)
                 
-            cmd_line+=' -acodec aac -ar 48k -ab 192k -strict experimental -max_muxing_queue_size 9999 -sn -threads {:d} -y \"{}\"'.format(self.__threads, self.__ffmpeg_output)
-            sys.stdout.write('> {}\n'.format(cmd_line))
-            exit_code=os.system(cmd_line)
+            if self.__chunks > 1 and self.__in_duration and not self.__can_copy_video():
+                self.__encoded=self.__chunked_encode()
+                return self.__encoded
             
-            if not exit_code:
-                if not self.__create_complete_mkv():
-                    return False
+            passlogfile=self.__get_passlogfile(self.__ffmpeg_output)
+            pass_number=self.__encoder.get_passes()[-1]
+            if self.__direct_mux:
+                cmd=self.__get_direct_mux_command(pass_number, passlogfile)
                 
-                if self.__replace_original:
-                    sys.stderr.write(_("WARNING: Deleting file {} as commanded with -r option.\nThis file won't be easily recovered.\n").format(self.__in_filename))
-                    os.remove(self.__in_filename)
-                        
+            else:
+                cmd=['ffmpeg', '-i', self.__in_filename] + self.__get_codec_options(pass_number, passlogfile) + ['-sn', '-y', self.__ffmpeg_output]
+                
+            try:
+                exit_code=0
+                label=os.path.basename(self.__in_filename)
+                if pass_number == 2 and not self.__can_copy_video():
+                    first_pass_cmd=self.__get_first_pass_command(self.__in_filename, passlogfile, self.__threads)
+                    self.__log.write('> {}\n'.format(' '.join(shlex.quote(arg) for arg in first_pass_cmd)))
+                    exit_code, self.__encode_stats=run_ffmpeg_with_progress(first_pass_cmd, self.__in_duration, _('{} (first pass)').format(label), self.__log, self.__run_tool)
+                    
+                if not exit_code:
+                    self.__log.write('> {}\n'.format(' '.join(shlex.quote(arg) for arg in cmd)))
+                    exit_code, self.__encode_stats=run_ffmpeg_with_progress(cmd, self.__in_duration, label, self.__log, self.__run_tool)
+                    
+            finally:
+                self.__remove_passlog_files(passlogfile)
+            
+            if not exit_code:
+                if self.__direct_mux:
+                    os.replace(self.__partial_output, self.get_output_filename())
+                    self.__mkv_output_complete=True
+                    self.__release_mkv_output()
+                    
+                self.__encoded=True
                 return True
+            
+            if self.__direct_mux and os.path.isfile(self.__partial_output):
+                os.remove(self.__partial_output) # Do not leave a broken output file behind.
+        
+        return False
+    
+    def mux(self):
+        """Runs the mkvmerge step over the ffmpeg output, returns True if it succeeded.
+        
+        """
+        if self.__transcoding_options_set:
+            return self.__direct_mux or self.__timed('mux', self.__create_complete_mkv)
+        
+        return False
+    
+    def remove_original(self):
+        """Deletes the input file if commanded with -r, once its final MKV file is complete.
+        
+        Callers keeping record of the files done have to record it before, not to lose both files.
+        """
+        if self.__replace_original and self.__mkv_output_complete:
+            sys.stderr.write(_("WARNING: Deleting file {} as commanded with -r option.\nThis file won't be easily recovered.\n").format(self.__in_filename))
+            os.remove(self.__in_filename)
+    
+    def transcode(self):
+        if self.encode() and self.mux():
+            self.remove_original()
+            return True
         
         return False
     
+    def resume_encoded(self, ffmpeg_output):
+        """Takes the output of a previous (interrupted) run of the ffmpeg step instead of encoding again.
+        
+        """
+        self.__ffmpeg_output=ffmpeg_output
+        self.__encoded=True
+        
+    def is_direct_mux(self):
+        return self.__direct_mux
+    
+    def get_output_filename(self):
+        """Returns the name of the final MKV file, choosing one not already in use the first time.
+        
+        """
+        if not self.__mkv_output:
+            self.__mkv_output=self.__get_mkv_output_filename()
+            
+        return self.__mkv_output
+    
+    def get_partial_output_filename(self):
+        """Returns the name the final MKV file has while being written, in its same directory, so it can be moved into place atomically.
+        
+        """
+        if not self.__partial_output:
+            self.__partial_output=os.path.splitext(self.get_output_filename())[0] + '_tmp_' + random_string(10) + '.mkv'
+            
+        return self.__partial_output
+    
+    def get_space_needs(self):
+        """Returns an estimation of the bytes needed in each directory written, as a dictionary.
+        
+        Without a target bitrate, the output is assumed not to be bigger than the input.
+        """
+        in_size=os.path.getsize(self.__in_filename)
+        output_size=in_size
+        bitrate=self.__encoder.get_bitrate() or self.__target_bitrate
+        if bitrate and self.__in_duration and not self.__can_copy_video():
+            output_size=int(self.__in_duration * (bitrate + 192) * 1000 / 8)
+            
+        needs={}
+        tmp_size=0
+        if not self.__direct_mux:
+            tmp_size+=output_size
+            
+        if self.__chunks > 1:
+            tmp_size+=in_size + output_size # Pieces before and after encoding.
+            
+        for directory, size in [(os.path.dirname(os.path.abspath(self.__ffmpeg_output)), tmp_size), (os.path.dirname(os.path.abspath(self.get_output_filename())), output_size)]:
+            if size:
+                needs[directory]=needs.get(directory, 0) + int(size * SPACE_MARGIN)
+                
+        return needs
+    
+    def get_intermediate_filename(self):
+        return self.__ffmpeg_output
+    
+    def get_temporary_files(self):
+        """Returns the intermediate files this video is going to create.
+        
+        """
+        tmp_files=list(self.__int_sub_files)
+        if self.__ffmpeg_output:
+            tmp_files.append(self.__ffmpeg_output)
+            
+        return tmp_files
+    
+    def __get_mkv_output_filename(self):
+        """Chooses a name not in use for the final MKV file, creating it empty and locked so no other job can take it.
+        
+        The empty file is replaced by the complete one at the end, or removed by clean(). An empty
+        file nobody holds locked was left by an interrupted run, and its name is taken again.
+        """
+        in_filename_root=os.path.splitext(self.__in_filename)[0]
+        prefix=''
+        while True:
+            mkv_output=in_filename_root+prefix+self.__output_postfix+'.mkv'
+            try:
+                fd=os.open(mkv_output, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                
+            except FileExistsError:
+                fd=self.__lock_stale_placeholder(mkv_output)
+                
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB) # Never blocks, nobody else has the new file.
+                self.__mkv_output_lock=fd
+                return mkv_output
+            
+            prefix+='_'
+            
+    @staticmethod
+    def __lock_stale_placeholder(filename):
+        """Returns an open descriptor of filename if it is an empty file left by an interrupted run, else None.
+        
+        """
+        try:
+            fd=os.open(filename, os.O_WRONLY)
+            
+        except OSError:
+            return None
+        
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            stat=os.fstat(fd)
+            if not stat.st_size and os.path.samestat(stat, os.stat(filename)): # Not replaced by its complete file meanwhile.
+                return fd
+            
+        except OSError:
+            pass
+        
+        os.close(fd)
+        return None
+    
+    def __release_mkv_output(self):
+        if self.__mkv_output_lock is not None:
+            os.close(self.__mkv_output_lock)
+            self.__mkv_output_lock=None
+    
     def __create_complete_mkv(self):
         if self.__ffmpeg_output:
-            ffmpeg_output_root=os.path.splitext(self.__ffmpeg_output)[0].replace(self.__ffmpeg_output_postfix,'')
-            mkv_output=ffmpeg_output_root+self.__output_postfix+'.mkv'
-            while os.path.isfile(mkv_output):
-                mkv_output = mkv_output.replace(self.__output_postfix, '_' + self.__output_postfix)
-
             if not self.__avlang:
                 self.__avlang = self.__default_avlang
                 
-            cmd_line="mkvmerge --default-language {} -o \"{}\" \"{}\"".format(self.__avlang,mkv_output,self.__ffmpeg_output)
+            cmd=['mkvmerge', '--default-language', self.__avlang, '-o', self.get_partial_output_filename(), self.__ffmpeg_output]
             sub_files = self.__ext_sub_files + self.__int_sub_files
             if sub_files:
                 for sub_file in sub_files:
@@ -220,140 +806,1359 @@ class Video:
                     else:
                         slang = self.__default_slang
                         
-                    cmd_line+="  --language 0:{}".format(slang)
+                    cmd+=['--language', '0:{}'.format(slang)]
                     self.__find_sub_charset(sub_file)
                     if self.__sub_charsets[sub_file]:
-                        cmd_line+=" --sub-charset 0:{}".format(self.__sub_charsets[sub_file])
+                        cmd+=['--sub-charset', '0:{}'.format(self.__sub_charsets[sub_file])]
                         
-                    cmd_line+=(" \"{}\" ".format(sub_file))
-                
+                    cmd.append(sub_file)
                 
-            sys.stdout.write('> {}\n'.format(cmd_line))
-            exit_status=os.system(cmd_line)
+            self.__log.write('> {}\n'.format(' '.join(shlex.quote(arg) for arg in cmd)))
+            exit_status=self.__run_tool(cmd)[0]
             if not exit_status:
-                #os.remove(self.__ffmpeg_output)
-                #self.__ffmpeg_output=None
-                return True        
+                os.replace(self.__partial_output, self.get_output_filename())
+                self.__mkv_output_complete=True
+                self.__release_mkv_output()
+                return True
+                
+            if os.path.isfile(self.__partial_output):
+                os.remove(self.__partial_output)
         
         return False
     
     def __find_sub_charset(self, filename):
-        cmd_output=os.popen("file -bi \"{}\" | sed -e 's/.*charset=//'".format(filename))
-        for line in cmd_output:
-            line=line.strip()
-            if line:
-                self.__sub_charsets[filename]=line
+        self.__sub_charsets[filename]=detect_charset(filename)
         
     def __get_crop_data(self):
         crop_data=None
-        crop_list=[]
-        tmp_output_filename=os.path.splitext(self.__in_filename)[0] + '_tmp_' + random_string(10)  +'_autocrop.mkv'
-        input_duration=self.__in_duration
-        if input_duration:
-            ss_list=[input_duration/x for x in random.sample(range(1,100),5)] # Cheacking autocrop in 5 random sites in the video.
-            for ss in ss_list:
-                #cmd_in_file,cmd_output_error_file=os.popen4("ffmpeg -ss %d -i \"%s\" -t 1 -filter cropdetect -y \"%s\"" % (ss,self.__in_filename,tmp_output_filename))
-                cproc = subprocess.run(["ffmpeg", "-ss", str(ss), "-i", self.__in_filename, "-t", "1", "-filter", "cropdetect", "-y", tmp_output_filename], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
-                for line in cproc.stderr.split('\n'):
-                    line=line.strip()
-                    if ('cropdetect' in line) and ('=' in line):
-                        crop_list.append(line.split('=')[1])
-                        
-            os.remove(tmp_output_filename)            
-            crop_set=set(crop_list)
-            crop_mode_cont=0
-            for crop in crop_set:
-                if crop_list.count(crop) > crop_mode_cont:
-                    crop_data=crop
-                    crop_mode_cont=crop_list.count(crop)
-            
-        sys.stdout.write('{}\n'.format(crop_data))
+        cached_crop=None
+        if self.__media_info_cache:
+            cached_crop=self.__media_info_cache.get(self.__in_filename, 'crop')
+            
+        if cached_crop and cached_crop['samples'] == self.__crop_samples:
+            crop_data=cached_crop['crop']
+            
+        elif self.__in_duration:
+            # A single decoding run over keyframes only, taking evenly spaced samples.
+            interval=self.__in_duration / self.__crop_samples
+            select="select='gte(t,{:.3f})*(isnan(prev_selected_t)+gte(t-prev_selected_t,{:.3f}))'".format(interval / 2, interval)
+            exit_code, output, errors = self.__run_tool(["ffmpeg", "-skip_frame", "nokey", "-i", self.__in_filename, "-map", "0:V:0", "-an", "-sn", "-vf", select + ",cropdetect=reset=1", "-f", "null", "-"], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            crop_list=CROP_REGEX.findall(errors)
+            if crop_list:
+                crop_data=collections.Counter(crop_list).most_common(1)[0][0]
+                
+            if self.__media_info_cache and not exit_code:
+                self.__media_info_cache.put(self.__in_filename, {'samples': self.__crop_samples, 'crop': crop_data}, 'crop')
+            
+        self.__log.write('{}\n'.format(crop_data))
         self.__crop_data=crop_data
         
     def __purge_int_sub_files(self):
         if self.__int_sub_files:
             for sub_file in self.__int_sub_files:
-                print(_("Removing temporary file '{}'.").format(sub_file))
+                self.__log.write(_("Removing temporary file '{}'.").format(sub_file) + '\n')
                 os.remove(sub_file)
                 
+            self.__int_sub_files=[]
+                
     def clean(self):
-        print(_("Removing temporary file '{}'.").format(self.__ffmpeg_output))
-        os.remove(self.__ffmpeg_output)
+        if self.__ffmpeg_output and os.path.isfile(self.__ffmpeg_output):
+            self.__log.write(_("Removing temporary file '{}'.").format(self.__ffmpeg_output) + '\n')
+            os.remove(self.__ffmpeg_output)
+            
         self.__ffmpeg_output = None
         self.__purge_int_sub_files()
+        if self.__mkv_output and not self.__mkv_output_complete and os.path.isfile(self.__mkv_output):
+            os.remove(self.__mkv_output) # The empty file keeping its name.
+            self.__mkv_output=None
+            
+        self.__release_mkv_output()
     
-class Reporter:
-    """Holds information about the transcoding process and elaborate a final report.
+class Encoder:
+    """Base class of the video encoder backends.
     
+    Each backend knows its ffmpeg encoder, the codec it produces (as named by ffprobe), its
+    presets and CRF range, and builds the ffmpeg options for constant quality (CRF), average
+    bitrate or two-pass encoding.
     """
-    def __init__(self):
-        self.__files_ok_counter=0
-        self.__files_with_error=[]
-        self.__ignored_files=[]
+    NAME=None
+    CODEC_NAME=None
+    PRESETS=[]
+    DEFAULT_PRESET=None
+    CRF_RANGE=(0, 51)
+    DEFAULT_CRF=23
+    TWO_PASS=True
+    
+    def __init__(self, preset=None, crf=None, bitrate=None, two_pass=False):
+        self._preset=preset if preset is not None else self.DEFAULT_PRESET
+        self._crf=crf if crf is not None else self.DEFAULT_CRF
+        self._bitrate=bitrate
+        self._two_pass=two_pass
         
-    def count_file_ok(self):
-        self.__files_ok_counter+=1
+    def check_options(self):
+        """Returns an error message if the options are not valid for this encoder, None otherwise.
         
-    def add_file_with_errors(self,filename):
-        self.__files_with_error.append(filename)
+        """
+        if self._preset not in self.PRESETS:
+            return _('Unknown preset "{}" for encoder {}.\nValid values are:\n\t{}\n').format(self._preset, self.NAME, '\n\t'.join(self.PRESETS))
         
-    def add_ignored_file(self,filename):
-        self.__ignored_files.append(filename)
+        if self._crf < self.CRF_RANGE[0] or self._crf > self.CRF_RANGE[1]:
+            return _('CRF values for encoder {} should be in the range of {:d} to {:d}.').format(self.NAME, *self.CRF_RANGE)
+        
+        if self._bitrate is not None and self._bitrate <= 0:
+            return _('The bitrate must be positive.')
+        
+        if self._two_pass and not self._bitrate:
+            return _('Two-pass encoding needs a target bitrate (-b).')
+        
+        if self._two_pass and not self.TWO_PASS:
+            return _('Encoder {} does not support two-pass encoding.').format(self.NAME)
+        
+        return None
+    
+    def get_codec_name(self):
+        return self.CODEC_NAME
+    
+    def get_crf(self):
+        return self._crf
+    
+    def get_bitrate(self):
+        return self._bitrate
+    
+    def get_default_crf(self):
+        return self.DEFAULT_CRF
+    
+    def get_crf_range(self):
+        return self.CRF_RANGE
+    
+    def set_crf(self, crf):
+        self._crf=min(max(crf, self.CRF_RANGE[0]), self.CRF_RANGE[1])
+        
+    def uses_crf(self):
+        return not self._bitrate
+    
+    def get_passes(self):
+        """Returns the pass numbers to run, [None] meaning a single pass.
         
-    def print_final_report(self):
-        """Print report after all transcoding is made.
         """
-        print(_('\n==== Transcoding finished ===='))
-        if self.__ignored_files:
-            print (_('== There following files were ignored: =='))
-            for filename in self.__ignored_files:
-                print('\t* {}'.format(filename))
-                
-            print(75*'=')
-            print('\n')
-            
-        if self.__files_with_error:
-            print(_('== There were errors transcoding the files: =='))
-            for filename in self.__files_with_error:
-                print('\t* {}'.format(filename))
-                
-            print(75*'=')
-            print('\n')
+        if self._two_pass:
+            return [1, 2]
+        
+        return [None]
+    
+    def _get_pass_options(self, pass_number, passlogfile):
+        return ['-pass', str(pass_number), '-passlogfile', passlogfile]
+    
+    def get_options(self, pass_number=None, passlogfile=None):
+        options=['-c:v', self.NAME, '-preset', self._preset]
+        if self._bitrate:
+            options+=['-b:v', '{:d}k'.format(self._bitrate)]
             
-        print(_('==== Final report ===='))
-        output = '\t {}'.format(self.__files_ok_counter)
-        if self.__files_ok_counter == 1:
-            output += _(' file')
-
         else:
-            output += _(' files')
+            options+=['-crf', str(self._crf)]
             
-        output += _(' transcoded OK.\n')
-        output += '\t {:d}'.format(len(self.__files_with_error))
-                    
-        if len(self.__files_with_error) == 1:
-            output += _(' file')
-
-        else:
-            output += _(' files')
+        if pass_number:
+            options+=self._get_pass_options(pass_number, passlogfile)
             
-        output+=_(' with errors.\n')
+        return options
+    
+class X264Encoder(Encoder):
+    NAME='libx264'
+    CODEC_NAME='h264'
+    PRESETS=["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow", "placebo"]
+    DEFAULT_PRESET='medium'
+    
+class X265Encoder(Encoder):
+    NAME='libx265'
+    CODEC_NAME='hevc'
+    PRESETS=X264Encoder.PRESETS
+    DEFAULT_PRESET='medium'
+    DEFAULT_CRF=28
+    
+    def _get_pass_options(self, pass_number, passlogfile):
+        return ['-x265-params', 'pass={:d}:stats={}'.format(pass_number, passlogfile)]
+    
+class SVTAV1Encoder(Encoder):
+    NAME='libsvtav1'
+    CODEC_NAME='av1'
+    PRESETS=[str(preset) for preset in range(14)]
+    DEFAULT_PRESET='8'
+    CRF_RANGE=(0, 63)
+    DEFAULT_CRF=35
+    TWO_PASS=False
+    
+class MediaInfo:
+    """Information about the streams of a media file, as reported by ffprobe.
+    
+    """
+    def __init__(self, probe_data):
+        self.__streams=probe_data.get('streams', [])
+        self.__format=probe_data.get('format', {})
         
-        sys.stdout.write(output)
-            
+    def __get_streams(self, codec_type):
+        return [stream for stream in self.__streams if stream.get('codec_type') == codec_type]
+    
+    def has_video(self):
+        """Returns True if there is at least one real video stream (not a cover picture nor a text file taken as video).
+        
+        """
+        for stream in self.__get_streams('video'):
+            if stream.get('codec_name') != 'ansi' and not stream.get('disposition', {}).get('attached_pic'):
+                return True
+            
+        return False
+    
+    def is_matroska(self):
+        return 'matroska' in self.__format.get('format_name', '')
+    
+    def get_duration(self):
+        """Returns the duration in seconds, or None if it is unknown.
+        
+        """
+        try:
+            return int(round(float(self.__format['duration'])))
+        
+        except (KeyError, ValueError):
+            return None
+        
+    def get_video_codec(self):
+        for stream in self.__get_streams('video'):
+            return stream.get('codec_name')
+        
+        return None
+    
+    def get_video_size(self):
+        """Returns the (width, height) of the video, or None if it is unknown.
+        
+        """
+        for stream in self.__get_streams('video'):
+            if 'width' in stream and 'height' in stream:
+                return stream['width'], stream['height']
+            
+        return None
+    
+    def get_audio_codecs(self):
+        return [stream.get('codec_name') for stream in self.__get_streams('audio')]
+    
+    def get_audio_language(self):
+        """Returns the language of the first audio stream that has a known one.
+        
+        """
+        for stream in self.__get_streams('audio'):
+            language=get_stream_language(stream)
+            if language:
+                return language
+            
+        return None
+    
+    def get_subtitle_tracks(self):
+        """Returns a list of (track id, codec name, language) tuples, one for each subtitle stream.
+        
+        For Matroska files the stream index is the track id used by mkvextract.
+        """
+        return [(stream['index'], stream.get('codec_name'), get_stream_language(stream)) for stream in self.__get_streams('subtitle')]
+        
+class MediaInfoCache:
+    """Keeps ffprobe results on disk, so unchanged files are never probed twice.
+    
+    Entries are appended to a JSON lines file, keyed by file path, size and modification time.
+    The outputs of the external programs, keyed by their binaries, are kept here too.
+    """
+    def __init__(self, cache_dir):
+        self.__filename=os.path.join(cache_dir, 'mediainfo.jsonl')
+        self.__entries=None
+        self.__lock=threading.Lock()
+        
+    def __load(self):
+        self.__entries={entry['path']: entry for entry in read_jsonl(self.__filename) if 'path' in entry}
+        
+    def __get_key(self, filename):
+        stat=os.stat(filename)
+        return os.path.realpath(filename), stat.st_size, stat.st_mtime_ns
+        
+    def get(self, filename, field='probe'):
+        """Returns the cached value of field for filename, or None if it is missing or outdated.
+        
+        """
+        path, size, mtime=self.__get_key(filename)
+        with self.__lock:
+            if self.__entries is None:
+                self.__load()
+                
+            entry=self.__entries.get(path)
+            
+        if entry and entry['size'] == size and entry['mtime'] == mtime:
+            return entry.get(field)
+        
+        return None
+        
+    def put(self, filename, value, field='probe'):
+        path, size, mtime=self.__get_key(filename)
+        with self.__lock:
+            if self.__entries is None:
+                self.__load()
+                
+            entry=self.__entries.get(path)
+            if not entry or entry['size'] != size or entry['mtime'] != mtime:
+                entry={'path': path, 'size': size, 'mtime': mtime}
+                
+            entry[field]=value
+            self.__entries[path]=entry
+            try:
+                os.makedirs(os.path.dirname(self.__filename), exist_ok=True)
+                with open(self.__filename, 'a') as cache_file:
+                    cache_file.write(json.dumps(entry) + '\n')
+                    
+            except OSError as error:
+                sys.stderr.write(_("WARNING: Unable to write cache file {}: {}\n").format(self.__filename, error))
+        
+class Journal:
+    """Keeps record of the stage reached by each file, so an interrupted batch can be resumed.
+    
+    Records are appended to a JSON lines file; the last one of each file tells its current state.
+    """
+    def __init__(self, filename):
+        self.__filename=filename
+        self.__entries={entry['path']: entry for entry in read_jsonl(filename) if 'path' in entry}
+        self.__lock=threading.Lock()
+        
+    def get(self, filename):
+        with self.__lock:
+            return self.__entries.get(os.path.realpath(filename))
+        
+    def record(self, filename, stage, **data):
+        """Records that filename reached stage, keeping the data of its previous records not given now.
+        
+        """
+        path=os.path.realpath(filename)
+        with self.__lock:
+            entry=dict(self.__entries.get(path, {}))
+            entry.update(data)
+            entry.update({'path': path, 'stage': stage, 'time': time.time()})
+            self.__entries[path]=entry
+            with open(self.__filename, 'a') as journal_file:
+                journal_file.write(json.dumps(entry) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            
+class JobQueue:
+    """A queue of files to transcode, kept in a SQLite database shared by a coordinator and the workers.
+    
+    Workers claim files with a lease, renewed while they are working on them. The files with an
+    expired lease, as those of a crashed worker, are claimed again by other workers.
+    """
+    def __init__(self, filename):
+        self.__filename=filename
+        with self.__connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS jobs (path TEXT PRIMARY KEY, options TEXT, state TEXT, worker TEXT, lease_expires REAL, attempts INTEGER, result TEXT)')
+            
+    def __connect(self):
+        import sqlite3
+        return sqlite3.connect(self.__filename, timeout=60, isolation_level=None) # Explicit transactions, to lock while claiming.
+    
+    def put(self, filename, options):
+        """Adds a file to be transcoded with the given TranscodeOptions. Returns False if it was already transcoded.
+        
+        Files which failed are queued again.
+        """
+        path=os.path.abspath(filename)
+        with contextlib.closing(self.__connect()) as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            row=connection.execute('SELECT state FROM jobs WHERE path = ?', (path,)).fetchone()
+            if row and row[0] == 'done':
+                connection.execute('COMMIT')
+                return False
+            
+            if not row or row[0] == 'failed':
+                connection.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, NULL, NULL, 0, NULL)', (path, json.dumps(vars(options)), 'pending'))
+                
+            connection.execute('COMMIT')
+            return True
+        
+    def claim(self, worker):
+        """Returns the name of a file to be transcoded by worker and its TranscodeOptions, or None if there is none.
+        
+        """
+        with contextlib.closing(self.__connect()) as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            now=time.time()
+            connection.execute("UPDATE jobs SET state = 'failed', result = ? WHERE state = 'running' AND lease_expires < ? AND attempts >= ?", (json.dumps({'error': _('Its workers stopped working on it {:d} times.').format(QUEUE_MAX_ATTEMPTS)}), now, QUEUE_MAX_ATTEMPTS))
+            row=connection.execute("SELECT path, options FROM jobs WHERE state = 'pending' OR (state = 'running' AND lease_expires < ?) ORDER BY path LIMIT 1", (now,)).fetchone()
+            if row:
+                connection.execute("UPDATE jobs SET state = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE path = ?", (worker, now + LEASE_TIME, row[0]))
+                
+            connection.execute('COMMIT')
+            
+        if not row:
+            return None
+        
+        return row[0], TranscodeOptions(**json.loads(row[1]))
+    
+    def renew(self, filename, worker):
+        """Extends the lease of a file claimed by worker, returns False if it is not held by it anymore.
+        
+        """
+        with contextlib.closing(self.__connect()) as connection:
+            cursor=connection.execute("UPDATE jobs SET lease_expires = ? WHERE path = ? AND worker = ? AND state = 'running'", (time.time() + LEASE_TIME, filename, worker))
+            return cursor.rowcount > 0
+        
+    def finish(self, filename, worker, state, result):
+        """Records the state ('done' or 'failed') and the result (a dictionary) of a file claimed by worker.
+        
+        """
+        with contextlib.closing(self.__connect()) as connection:
+            connection.execute("UPDATE jobs SET state = ?, result = ?, lease_expires = NULL WHERE path = ? AND worker = ?", (state, json.dumps(result), filename, worker))
+            
+    def has_unfinished(self, filenames=None):
+        """Tells if any of the given files, or of all files if not given, is waiting or being transcoded.
+        
+        """
+        return any(state in ['pending', 'running'] for path, state, result in self.get_states(filenames))
+    
+    def get_states(self, filenames=None):
+        """Returns the path, state and result (None until finished) of the given files, or of all of them.
+        
+        """
+        with contextlib.closing(self.__connect()) as connection:
+            rows=connection.execute('SELECT path, state, result FROM jobs ORDER BY path').fetchall()
+            
+        paths=None
+        if filenames is not None:
+            paths=set(os.path.abspath(filename) for filename in filenames)
+            
+        return [(path, state, result and json.loads(result)) for path, state, result in rows if paths is None or path in paths]
+    
+class Reporter:
+    """Holds information about the transcoding process and elaborate a final report.
+    
+    """
+    def __init__(self):
+        self.__files_ok_counter=0
+        self.__files_with_error=[]
+        self.__ignored_files=[]
+        self.__skipped_files=[]
+        self.__metrics={}
+        self.__lock=threading.Lock() # Several transcoding jobs may report at the same time.
+        
+    def count_file_ok(self):
+        with self.__lock:
+            self.__files_ok_counter+=1
+        
+    def add_file_with_errors(self,filename):
+        with self.__lock:
+            self.__files_with_error.append(filename)
+        
+    def add_ignored_file(self,filename):
+        with self.__lock:
+            self.__ignored_files.append(filename)
+        
+    def add_skipped_file(self,filename):
+        with self.__lock:
+            self.__skipped_files.append(filename)
+            
+    def add_metrics(self, filename, stage_times, encode_stats, tool_time=None):
+        with self.__lock:
+            self.__metrics[filename]={'stage_times': stage_times, 'encode_stats': encode_stats, 'tool_time': tool_time}
+            
+    def add_queue_results(self, states):
+        """Adds the results of the files transcoded by the workers of a job queue, as given by JobQueue.get_states.
+        
+        """
+        for path, state, result in states:
+            if state == 'done':
+                self.count_file_ok()
+                
+            elif state == 'failed':
+                self.add_file_with_errors(path)
+                
+            if result and 'stage_times' in result:
+                self.add_metrics(path, result['stage_times'], result['encode_stats'], result.get('tool_time'))
+                
+    def __get_total_stage_times(self):
+        total_times={}
+        for metrics in self.__metrics.values():
+            for stage, seconds in metrics['stage_times'].items():
+                total_times[stage]=total_times.get(stage, 0) + seconds
+                
+        return total_times
+    
+    def __get_total_overhead(self):
+        """Returns the seconds spent by the script itself, not waiting for external programs, in all files.
+        
+        """
+        overhead=0
+        for metrics in self.__metrics.values():
+            if metrics.get('tool_time') is not None:
+                overhead+=max(0, sum(metrics['stage_times'].values()) - metrics['tool_time'])
+                
+        return overhead
+    
+    def write_metrics(self, filename, tool_versions=None):
+        """Writes the time spent in each stage, per file and in total, the encoding statistics and the versions of the tools used as JSON.
+        
+        """
+        with open(filename, 'w') as metrics_file:
+            json.dump({'files': self.__metrics, 'total_stage_times': self.__get_total_stage_times(), 'total_overhead': self.__get_total_overhead(), 'tool_versions': tool_versions}, metrics_file, indent=2)
+        
+    def print_final_report(self):
+        """Print report after all transcoding is made.
+        """
+        print(_('\n==== Transcoding finished ===='))
+        if self.__ignored_files:
+            print (_('== There following files were ignored: =='))
+            for filename in self.__ignored_files:
+                print('\t* {}'.format(filename))
+                
+            print(75*'=')
+            print('\n')
+            
+        if self.__skipped_files:
+            print(_('== The following files were already transcoded in a previous run: =='))
+            for filename in self.__skipped_files:
+                print('\t* {}'.format(filename))
+                
+            print(75*'=')
+            print('\n')
+            
+        if self.__files_with_error:
+            print(_('== There were errors transcoding the files: =='))
+            for filename in self.__files_with_error:
+                print('\t* {}'.format(filename))
+                
+            print(75*'=')
+            print('\n')
+            
+        total_times=self.__get_total_stage_times()
+        if total_times:
+            print(_('== Time spent in each stage (added over all files): =='))
+            for stage in STAGES:
+                if stage in total_times:
+                    print('\t{:8s} {}'.format(stage, print_duration(total_times[stage]) or '0'))
+                    
+            print(_('\tof them, {} in the script itself (not running ffmpeg, mkvmerge...).').format(print_duration(self.__get_total_overhead()) or '0'))
+            print(75*'=')
+            print('\n')
+            
+        print(_('==== Final report ===='))
+        output = '\t {}'.format(self.__files_ok_counter)
+        if self.__files_ok_counter == 1:
+            output += _(' file')
+
+        else:
+            output += _(' files')
+            
+        output += _(' transcoded OK.\n')
+        output += '\t {:d}'.format(len(self.__files_with_error))
+                    
+        if len(self.__files_with_error) == 1:
+            output += _(' file')
+
+        else:
+            output += _(' files')
+            
+        output+=_(' with errors.\n')
+        
+        sys.stdout.write(output)
+            
         print(75*'=')
         print('\n')
 
+class Job:
+    """A file going through the transcoding pipeline.
+    
+    """
+    def __init__(self, filename, counter, n_files=None):
+        self.filename=filename
+        self.counter=counter
+        self.n_files=n_files # Unknown for files arriving in watch mode.
+        self.video=None
+        self.space_reservation=None
+        
+    def get_position(self):
+        if self.n_files:
+            return '{:d}/{:d}'.format(self.counter, self.n_files)
+        
+        return '{:d}'.format(self.counter)
+        
+class DiskSpace:
+    """Keeps track of the disk space reserved by the running jobs, per file system.
+    
+    A job waits while the space it needs is held by other jobs, and fails if there is not
+    enough free space even without them.
+    """
+    def __init__(self):
+        self.__reserved={}
+        self.__condition=threading.Condition()
+        
+    def reserve(self, needs):
+        """Reserves the bytes needed in each directory. Returns the reservation, or None if there is not enough space.
+        
+        """
+        reservation={}
+        directories={}
+        for directory, size in needs.items():
+            device=os.stat(directory).st_dev
+            reservation[device]=reservation.get(device, 0) + size
+            directories[device]=directory
+            
+        with self.__condition:
+            while True:
+                short=[device for device, size in reservation.items() if shutil.disk_usage(directories[device]).free - self.__reserved.get(device, 0) < size]
+                if not short:
+                    for device, size in reservation.items():
+                        self.__reserved[device]=self.__reserved.get(device, 0) + size
+                        
+                    return reservation
+                
+                if not any(self.__reserved.get(device) for device in short):
+                    for device in short:
+                        sys.stderr.write(_('ERROR: Not enough free space in {}: {} MB needed, {} MB available.\n').format(directories[device], reservation[device] // (1024 * 1024), shutil.disk_usage(directories[device]).free // (1024 * 1024)))
+                        
+                    return None
+                
+                print(_('Waiting for other files to finish, to have enough free space in {}.').format(', '.join(directories[device] for device in short)))
+                self.__condition.wait()
+                
+    def release(self, reservation):
+        with self.__condition:
+            for device, size in reservation.items():
+                self.__reserved[device]-=size
+                
+            self.__condition.notify_all()
+        
+class ProcessGroup:
+    """The external programs running for a file, which can be killed at once from another thread.
+    
+    Once killed, any program added is killed at once, so no more of them can run.
+    """
+    def __init__(self):
+        self.__processes=set()
+        self.__killed=False
+        self.__lock=threading.Lock()
+        
+    def add(self, proc):
+        with self.__lock:
+            self.__processes.add(proc)
+            if self.__killed:
+                proc.kill()
+                
+    def discard(self, proc):
+        with self.__lock:
+            self.__processes.discard(proc)
+            
+    def kill(self):
+        with self.__lock:
+            self.__killed=True
+            for proc in self.__processes:
+                try:
+                    proc.kill()
+                    
+                except ProcessLookupError:
+                    pass
+                
+    def is_killed(self):
+        return self.__killed
+    
+class InputFilter:
+    """Cheap checks done on the input files before probing them.
+    
+    Files found in directories are rejected by extension and size, when they are outputs or
+    temporary files of this script and when their output already exists. Any file is rejected
+    (optionally) when its content is the same as the one of a file already accepted.
+    """
+    def __init__(self, extensions, min_size, postfix, force, dedup, reporter):
+        self.__extensions=[extension.lower() for extension in extensions if extension]
+        self.__min_size=min_size
+        self.__postfix=postfix
+        self.__force=force
+        self.__dedup=dedup
+        self.__reporter=reporter
+        self.__seen_paths=set()
+        self.__seen_hashes={}
+        
+    def accept(self, filename, explicit=True):
+        """Returns True if filename has to be transcoded. Files given explicitly are always tried,
+        as they always were, unless they are duplicated.
+        
+        """
+        if not os.path.isfile(filename):
+            return True # Let it be reported as not being a proper video file.
+        
+        path=os.path.realpath(filename)
+        if path in self.__seen_paths:
+            return False
+        
+        self.__seen_paths.add(path)
+        root, extension=os.path.splitext(filename)
+        if not explicit:
+            if root.endswith(self.__postfix) or '_tmp_' in os.path.basename(root):
+                return False
+            
+            if (self.__extensions and extension.lower() not in self.__extensions) or os.path.getsize(filename) < self.__min_size:
+                return False
+            
+            output=root + self.__postfix + '.mkv'
+            if not self.__force and os.path.isfile(output) and os.path.getsize(output): # An empty one is a placeholder, maybe left by an interrupted run.
+                print(_('File {} already has an output file, skipping it.').format(filename))
+                self.__reporter.add_skipped_file(filename)
+                return False
+        
+        if self.__dedup:
+            content_hash=get_quick_hash(filename)
+            if content_hash in self.__seen_hashes:
+                print(_('File {} has the same content as {}, skipping it.').format(filename, self.__seen_hashes[content_hash]))
+                self.__reporter.add_ignored_file(filename)
+                return False
+            
+            self.__seen_hashes[content_hash]=filename
+            
+        return True
+    
+class DirectoryWatcher:
+    """Iterates over the files arriving to some directories, forever.
+    
+    Uses inotify where available (Linux), to get a file once it is completely written
+    or moved into place. Otherwise directories are scanned periodically, taking the new
+    files whose size did not change since the previous scan.
+    """
+    def __init__(self, directories, recursive):
+        self.__directories=directories
+        self.__recursive=recursive
+        self.__libc=None
+        import ctypes
+        import ctypes.util
+        library=ctypes.util.find_library('c')
+        if library:
+            libc=ctypes.CDLL(library, use_errno=True)
+            if hasattr(libc, 'inotify_init'):
+                self.__libc=libc
+                
+    def __iter__(self):
+        if self.__libc:
+            return self.__watch_with_inotify()
+        
+        return self.__watch_polling()
+    
+    def __add_watch(self, fd, watches, directory):
+        mask=INOTIFY_CLOSE_WRITE | INOTIFY_MOVED_TO | INOTIFY_CREATE
+        wd=self.__libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+        if wd >= 0:
+            watches[wd]=directory
+            
+        if self.__recursive:
+            for entry in os.scandir(directory):
+                if entry.is_dir():
+                    self.__add_watch(fd, watches, entry.path)
+                    
+    def __watch_with_inotify(self):
+        fd=self.__libc.inotify_init()
+        if fd < 0:
+            yield from self.__watch_polling()
+            return
+        
+        watches={}
+        for directory in self.__directories:
+            self.__add_watch(fd, watches, directory)
+            
+        while True:
+            buffer=os.read(fd, 64 * 1024)
+            offset=0
+            while offset < len(buffer):
+                wd, mask, cookie, length=struct.unpack_from('iIII', buffer, offset)
+                name=os.fsdecode(buffer[offset + 16:offset + 16 + length].rstrip(b'\0'))
+                offset+=16 + length
+                if wd not in watches or not name:
+                    continue
+                
+                path=os.path.join(watches[wd], name)
+                if mask & INOTIFY_ISDIR:
+                    if self.__recursive and mask & (INOTIFY_CREATE | INOTIFY_MOVED_TO):
+                        self.__add_watch(fd, watches, path)
+                        
+                elif mask & (INOTIFY_CLOSE_WRITE | INOTIFY_MOVED_TO):
+                    yield path
+                    
+    def __watch_polling(self):
+        known=set(find_input_files(self.__directories, self.__recursive))
+        sizes={}
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL)
+            new_sizes={}
+            for filename in find_input_files(self.__directories, self.__recursive):
+                if filename not in known:
+                    new_sizes[filename]=os.path.getsize(filename)
+                    if sizes.get(filename) == new_sizes[filename]:
+                        known.add(filename)
+                        del new_sizes[filename]
+                        yield filename
+                        
+            sizes=new_sizes
+            
+class Pipeline:
+    """Runs items through a sequence of stages, each one with its own worker threads.
+    
+    Stages are connected by bounded queues, so while an item is in a stage the next ones
+    can already be in the previous stages, but not too many of them are kept waiting.
+    A stage function returns the item to pass to the next stage, or None to drop it.
+    """
+    def __init__(self, queue_size=1, error_handler=None):
+        self.__stages=[]
+        self.__queue_size=queue_size
+        self.__error_handler=error_handler
+        
+    def add_stage(self, function, workers=1):
+        self.__stages.append((function, workers))
+        
+    def __work(self, stage, queues, running, lock):
+        function, workers = self.__stages[stage]
+        out_queue=None
+        if stage + 1 < len(self.__stages):
+            out_queue=queues[stage + 1]
+            
+        while True:
+            item=queues[stage].get()
+            if item is None:
+                with lock:
+                    running[stage]-=1
+                    last_worker = not running[stage]
+                    
+                if last_worker and out_queue:
+                    for n in range(self.__stages[stage + 1][1]):
+                        out_queue.put(None)
+                        
+                return
+            
+            try:
+                item=function(item)
+                
+            except Exception as error:
+                if not self.__error_handler:
+                    raise
+                
+                self.__error_handler(item, error)
+                item=None
+                
+            if item is not None and out_queue:
+                out_queue.put(item)
+                
+    def run(self, items):
+        """Feeds all items to the first stage and waits until the last one is done with them.
+        
+        """
+        queues=[queue.Queue(maxsize=self.__queue_size) for stage in self.__stages]
+        running=[workers for function, workers in self.__stages]
+        lock=threading.Lock()
+        threads=[]
+        for stage, (function, workers) in enumerate(self.__stages):
+            for n in range(workers):
+                thread=threading.Thread(target=self.__work, args=(stage, queues, running, lock), daemon=True)
+                thread.start()
+                threads.append(thread)
+                
+        for item in items:
+            queues[0].put(item)
+            
+        for n in range(self.__stages[0][1]):
+            queues[0].put(None)
+            
+        for thread in threads:
+            thread.join()
+    
+class TranscodeOptions:
+    """The options used to transcode each file, as given in the command line.
+    
+    Attributes are named as the arguments of Video.set_transcoding_options, and their defaults
+    are the same of the command line options.
+    """
+    def __init__(self, preset=None, crf=None, replace_original=False, avlang='eng', slang='spa', postfix='_h264', threads=0, auto_crop=False, direct_mux=False, smart_copy=False, chunks=0, crop_samples=20, srt=False, encoder='libx264', bitrate=None, two_pass=False, target_bitrate=None, target_quality=None, quality_metric='ssim'):
+        self.preset=preset
+        self.crf=crf
+        self.replace_original=replace_original
+        self.avlang=avlang
+        self.slang=slang
+        self.postfix=postfix
+        self.threads=threads
+        self.auto_crop=auto_crop
+        self.direct_mux=direct_mux
+        self.smart_copy=smart_copy
+        self.chunks=chunks
+        self.crop_samples=crop_samples
+        self.srt=srt
+        self.encoder=encoder
+        self.bitrate=bitrate
+        self.two_pass=two_pass
+        self.target_bitrate=target_bitrate
+        self.target_quality=target_quality
+        self.quality_metric=quality_metric
+        
+    @classmethod
+    def from_args(cls, args):
+        """Takes the options from the parsed command line.
+        
+        """
+        return cls(args.preset, args.crf, args.replace, args.avlang, args.slang, args.filename_postfix, args.threads, args.auto_crop, args.direct_mux, args.smart_copy, args.chunks, args.crop_samples, args.srt, args.encoder, args.bitrate, args.two_pass, args.target_bitrate, args.target_quality, args.quality_metric)
+    
+    def check(self):
+        """Returns an error message if the options are not valid, None otherwise.
+        
+        """
+        if self.threads < 0:
+            return _('The number of threads must be 0 or positive.')
+        
+        if self.crop_samples < 1:
+            return _('The number of crop samples must be positive.')
+        
+        if self.chunks < 0:
+            return _('The number of chunks must be 0 or positive.')
+        
+        if self.chunks > 1 and self.direct_mux:
+            return _('Options --chunks and --direct-mux can not be used together.')
+        
+        if self.encoder not in ENCODERS:
+            return _('Unknown encoder "{}".').format(self.encoder)
+        
+        encoder_error=ENCODERS[self.encoder](self.preset, self.crf, self.bitrate, self.two_pass).check_options()
+        if encoder_error:
+            return encoder_error
+        
+        if self.target_bitrate is not None and self.target_bitrate <= 0:
+            return _('The target bitrate must be positive.')
+        
+        if self.target_bitrate and self.target_quality:
+            return _('Options --target-bitrate and --target-quality can not be used together.')
+        
+        if (self.target_bitrate or self.target_quality) and self.bitrate:
+            return _('A target bitrate or quality can only be used with CRF encoding, not with -b.')
+        
+        if self.quality_metric not in QUALITY_FILTERS:
+            return _('Unknown quality metric "{}".').format(self.quality_metric)
+        
+        if self.target_quality is not None and not 0 < self.target_quality <= {'ssim': 1, 'vmaf': 100}[self.quality_metric]:
+            return _('The target quality is out of the range of the {} metric.').format(self.quality_metric)
+        
+        return None
+    
+class TranscodeResult:
+    """What transcode_file() returns: the final file, the time spent in each stage and in external programs, and the encoding statistics.
+    
+    """
+    def __init__(self, filename, output_filename, stage_times, encode_stats, tool_time):
+        self.filename=filename
+        self.output_filename=output_filename
+        self.stage_times=stage_times
+        self.encode_stats=encode_stats
+        self.tool_time=tool_time
+        
+class AsyncTranscoder:
+    """Transcodes files from an asyncio event loop, up to max_jobs of them at the same time.
+    
+    The steps of each file run in a worker thread, but every external program is started from the
+    event loop with asyncio.create_subprocess_exec(). Cancelling the task transcoding a file kills
+    its running programs, and no new ones are started for it.
+    """
+    def __init__(self, options, max_jobs=1, media_info_cache=None, tmp_dir=None, log=None):
+        self.__options=options
+        self.__max_jobs=max_jobs
+        self.__media_info_cache=media_info_cache
+        self.__tmp_dir=tmp_dir
+        self.__log=log
+        self.__semaphore=None # Created in the event loop, when first needed.
+        import concurrent.futures
+        self.__executor=concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs)
+        
+    async def __run_process(self, cmd, stdout, stderr, line_handler, processes):
+        import asyncio
+        proc=await asyncio.create_subprocess_exec(*get_tool_command(cmd), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE if line_handler else stdout, stderr=stderr)
+        processes.add(proc)
+        try:
+            output=None
+            errors=None
+            if line_handler:
+                async for line in proc.stdout:
+                    line_handler(line.decode(errors='replace'))
+                    
+                if stderr == subprocess.PIPE:
+                    errors=await proc.stderr.read()
+                    
+            else:
+                output, errors = await proc.communicate()
+                
+            exit_code=await proc.wait()
+            
+        finally:
+            processes.discard(proc)
+            
+        return exit_code, output and output.decode(errors='replace'), errors and errors.decode(errors='replace')
+    
+    async def transcode(self, filename):
+        """Transcodes a file as transcode_file() does, waiting first for a free job slot.
+        
+        """
+        import asyncio
+        if not self.__semaphore:
+            self.__semaphore=asyncio.Semaphore(self.__max_jobs)
+            
+        async with self.__semaphore:
+            loop=asyncio.get_running_loop()
+            processes=set()
+            cancelled=threading.Event()
+            
+            def process_runner(cmd, stdout=None, stderr=None, line_handler=None):
+                if cancelled.is_set():
+                    raise TranscodeError(_('Transcoding of {} was cancelled.').format(filename))
+                
+                return asyncio.run_coroutine_threadsafe(self.__run_process(cmd, stdout, stderr, line_handler, processes), loop).result()
+            
+            future=loop.run_in_executor(self.__executor, transcode_file, filename, self.__options, self.__media_info_cache, self.__tmp_dir, self.__log, process_runner)
+            try:
+                return await asyncio.shield(future)
+            
+            except asyncio.CancelledError:
+                cancelled.set()
+                for proc in list(processes):
+                    try:
+                        proc.kill()
+                        
+                    except ProcessLookupError:
+                        pass
+                    
+                try:
+                    await future # Let the worker thread remove the temporary files.
+                    
+                except Exception:
+                    pass
+                
+                raise
+            
+    async def transcode_all(self, filenames):
+        """Transcodes all the files, returning for each one its TranscodeResult or the TranscodeError raised.
+        
+        """
+        import asyncio
+        return await asyncio.gather(*[self.transcode(filename) for filename in filenames], return_exceptions=True)
+    
+ENCODERS=dict((encoder.NAME, encoder) for encoder in [X264Encoder, X265Encoder, SVTAV1Encoder])
+
 ## Functions
 def check_the_required_programs():
-    if os.system("ffmpeg -h > /dev/null 2>&1"):
+    """Looks for the external programs in PATH, keeping their full paths in TOOLS. Exits if some of them is missing.
+    
+    """
+    for tool in TOOLS:
+        TOOLS[tool]=shutil.which(TOOLS[tool]) or TOOLS[tool]
+        
+    if not os.path.isabs(TOOLS['ffmpeg']) or not os.path.isabs(TOOLS['ffprobe']):
         sys.stderr.write(_("ERROR: ffmpeg is not installed in your system.\nThis script can not work properly without it.\n\n"))
         exit()
         
-    if os.system("mkvmerge -h > /dev/null"):
+    if not os.path.isabs(TOOLS['mkvmerge']) or not os.path.isabs(TOOLS['mkvextract']):
         sys.stderr.write(_("ERROR: mkvtoolnix is not installed in your system.\nThis script can not work properly without it.\n\n"))
         exit()
         
+def get_tool_command(cmd):
+    """Returns cmd running the binary set in TOOLS, if it is one of them.
+    
+    """
+    return [TOOLS.get(cmd[0], cmd[0])] + cmd[1:]
+
+def run_process(cmd, stdout=None, stderr=None, line_handler=None, processes=None):
+    """Runs a command, without a shell and with its input closed. Every external program is run through here.
+    
+    Returns its exit code, and its standard output and error as text when they are subprocess.PIPE.
+    If line_handler is given, it is called with each line of the standard output as soon as it is read.
+    If processes (a ProcessGroup) is given, the process is kept there while running, to be killed from other threads.
+    """
+    proc=subprocess.Popen(get_tool_command(cmd), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE if line_handler else stdout, stderr=stderr, universal_newlines=True)
+    if processes is not None:
+        processes.add(proc)
+        
+    try:
+        if line_handler:
+            for line in proc.stdout:
+                line_handler(line)
+                
+            errors=None
+            if stderr == subprocess.PIPE:
+                errors=proc.stderr.read()
+                
+            return proc.wait(), None, errors
+        
+        output, errors = proc.communicate()
+        return proc.returncode, output, errors
+    
+    finally:
+        if processes is not None:
+            processes.discard(proc)
+
+def score_legacy_text(text):
+    """Tells how much text looks like natural language, to choose among legacy charsets.
+    
+    Words with letters of different scripts, Latin words made mostly of non-ASCII letters, and
+    capital letters in the middle of words (as KOI8-R text read as CP1251 and vice versa)
+    are penalized. Control characters are a sure sign of the wrong charset.
+    """
+    import unicodedata
+    score=-10*sum(1 for char in text if unicodedata.category(char) == 'Cc' and char not in '\r\n\t')
+    for word in WORD_REGEX.findall(text):
+        non_ascii=[char for char in word if ord(char) > 127]
+        if not non_ascii:
+            continue
+        
+        scripts=set(unicodedata.name(char, 'UNKNOWN').split()[0] for char in non_ascii)
+        n_ascii=len(word)-len(non_ascii)
+        if len(scripts) > 1 or ('LATIN' not in scripts and n_ascii) or ('LATIN' in scripts and len(non_ascii) > n_ascii):
+            score-=len(word)
+            continue
+        
+        score+=sum(1 if char.islower() else -1 for char in word[1:])
+        
+    return score
+
+def detect_charset(filename):
+    """Guesses the charset of a text file, reading only its first bytes. Returns None if it is not text.
+    
+    Byte order marks are checked first, then if it is valid ASCII or UTF-8, and at last the legacy
+    charset giving the most natural looking text is chosen. Results are cached per file.
+    """
+    stat=os.stat(filename)
+    key=(os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+    with charset_cache_lock:
+        if key in charset_cache:
+            return charset_cache[key]
+        
+    with open(filename, 'rb') as text_file:
+        data=text_file.read(CHARSET_SAMPLE_SIZE)
+        
+    charset=None
+    for bom, bom_charset in CHARSET_BOMS:
+        if data.startswith(bom):
+            charset=bom_charset
+            break
+        
+    if not charset and b'\x00' not in data:
+        try:
+            data.decode('ascii')
+            charset='us-ascii'
+            
+        except UnicodeDecodeError:
+            try:
+                codecs.getincrementaldecoder('utf-8')().decode(data, final=len(data) < CHARSET_SAMPLE_SIZE) # The sample may cut a character.
+                charset='utf-8'
+                
+            except UnicodeDecodeError:
+                charset=max(LEGACY_CHARSETS, key=lambda legacy_charset: score_legacy_text(data.decode(legacy_charset, errors='replace')))
+                
+    with charset_cache_lock:
+        charset_cache[key]=charset
+        
+    return charset
+
+def read_jsonl(filename):
+    """Returns the records of a JSON lines file, or an empty list if it does not exist.
+    
+    """
+    records=[]
+    if os.path.isfile(filename):
+        with open(filename, 'r') as jsonl_file:
+            for line in jsonl_file:
+                try:
+                    record=json.loads(line)
+                    
+                except ValueError:
+                    continue # A line cut by an interrupted run, just ignore it.
+                
+                if isinstance(record, dict):
+                    records.append(record)
+                    
+    return records
+    
+def get_default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'transcode2H264')
+
+def get_stream_language(stream):
+    """Returns the language tag of an ffprobe stream, or None if it is missing or undetermined.
+    
+    """
+    language=stream.get('tags', {}).get('language')
+    if not language or "unk" in language.lower() or "und" in language.lower():
+        return None
+    
+    return language
+
+def probe_media(filename, cache=None, process_runner=run_process):
+    """Returns a MediaInfo for filename, running ffprobe only if it is not already in cache.
+    
+    """
+    probe_data=None
+    if cache:
+        probe_data=cache.get(filename)
+        
+    if probe_data is None:
+        exit_code, output, errors = process_runner(["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", filename], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            probe_data=json.loads(output)
+            
+        except ValueError:
+            return MediaInfo({})
+        
+        if cache and not exit_code: # A failure may be transient, probe it again next time.
+            cache.put(filename, probe_data)
+            
+    return MediaInfo(probe_data)
+    
+def run_ffmpeg_with_progress(cmd, duration, label, log=None, process_runner=run_process):
+    """Runs an ffmpeg command showing its progress, ETA included when the duration is known.
+    
+    Returns the exit code and the last progress values reported by ffmpeg.
+    """
+    cmd=cmd[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd[1:]
+    log=log or sys.stdout
+    stats={}
+    last_report_time=[0]
+    to_terminal=log.isatty()
+    
+    def show_progress(line):
+        key, separator, value=line.strip().partition('=')
+        if not separator:
+            return
+        
+        if key != 'progress':
+            stats[key]=value.strip()
+            return
+        
+        if not to_terminal and value != 'end' and time.time() - last_report_time[0] < PROGRESS_INTERVAL:
+            return
+        
+        last_report_time[0]=time.time()
+        output='{}: {} fps={} speed={} bitrate={}'.format(label, stats.get('out_time', '').split('.')[0], stats.get('fps', ''), stats.get('speed', ''), stats.get('bitrate', ''))
+        try:
+            out_seconds=int(stats['out_time_us']) / 1000000
+            speed=float(stats['speed'].rstrip('x'))
+            if duration:
+                output+=' ({:.1f}%'.format(min(100, 100 * out_seconds / duration))
+                if speed > 0:
+                    output+=_(', ETA {}').format(print_duration(max(0, duration - out_seconds) / speed) or '0')
+                    
+                output+=')'
+                
+        except (KeyError, ValueError):
+            pass
+        
+        if to_terminal:
+            log.write('\r' + output + '\033[K')
+            if value == 'end':
+                log.write('\n')
+                
+        else:
+            log.write(output + '\n')
+            
+        log.flush()
+        
+    return process_runner(cmd, line_handler=show_progress)[0], stats
+
+def measure_quality(distorted, reference, position, duration, crop_data, metric, process_runner=run_process):
+    """Compares an encoded sample with the same piece of the original video, using the ssim or vmaf metric.
+    
+    Returns the SSIM (0 to 1) or VMAF (0 to 100) score, or None if it could not be measured.
+    """
+    reference_filter='[1:v]'
+    if crop_data:
+        reference_filter+='crop={},'.format(crop_data)
+        
+    lavfi=reference_filter + 'setpts=PTS-STARTPTS[reference];[0:v]setpts=PTS-STARTPTS[distorted];[distorted][reference]' + QUALITY_FILTERS[metric]
+    cmd=['ffmpeg', '-i', distorted, '-ss', '{:.3f}'.format(position), '-t', '{:.3f}'.format(duration), '-i', reference, '-lavfi', lavfi, '-f', 'null', '-']
+    exit_code, output, errors = process_runner(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    match=QUALITY_REGEXES[metric].search(errors)
+    if exit_code or not match:
+        return None
+    
+    return float(match.group(1))
+
+def get_tool_output(tool, args, field, cache=None):
+    """Returns the output of one of the TOOLS run with args, kept in cache (keyed by the binary) as field.
+    
+    """
+    output=None
+    if cache and os.path.isabs(TOOLS[tool]):
+        output=cache.get(TOOLS[tool], field)
+        
+    if output is None:
+        exit_code, output, errors = run_process([tool] + args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if cache and os.path.isabs(TOOLS[tool]) and not exit_code:
+            cache.put(TOOLS[tool], output, field)
+            
+    return output
+
+def get_tool_version(tool, cache=None):
+    """Returns the first line of the version information of one of the TOOLS.
+    
+    """
+    version_option='-version' if tool in ['ffmpeg', 'ffprobe'] else '--version'
+    return get_tool_output(tool, [version_option], 'version', cache).split('\n')[0].strip()
+
+def has_ffmpeg_filter(filter_name, cache=None):
+    output=get_tool_output('ffmpeg', ['-hide_banner', '-filters'], 'filters', cache)
+    return any(line.split()[1:2] == [filter_name] for line in output.split('\n'))
+
+def get_quick_hash(filename):
+    """Returns a hash of the size and the first and last blocks of a file, enough to tell duplicated videos.
+    
+    """
+    import hashlib
+    content_hash=hashlib.sha1(str(os.path.getsize(filename)).encode())
+    with open(filename, 'rb') as in_file:
+        content_hash.update(in_file.read(QUICK_HASH_BLOCK_SIZE))
+        if os.path.getsize(filename) > QUICK_HASH_BLOCK_SIZE:
+            in_file.seek(-QUICK_HASH_BLOCK_SIZE, os.SEEK_END)
+            content_hash.update(in_file.read(QUICK_HASH_BLOCK_SIZE))
+            
+    return content_hash.hexdigest()
+
+def find_input_files(paths, recursive):
+    """Yields the files given in paths and those inside the directories given, sorted by name.
+    
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        
+        for directory, subdirectories, filenames in os.walk(path):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                yield os.path.join(directory, filename)
+                
+            if not recursive:
+                break
+            
+def generate_jobs(paths, input_filter, recursive, watch):
+    """Yields a Job for each input file accepted, and then for the files arriving to the input directories if watch is set.
+    
+    """
+    filenames=[filename for filename in find_input_files(paths, recursive) if input_filter.accept(filename, filename in paths)]
+    for file_counter, filename in enumerate(filenames, 1):
+        yield Job(filename, file_counter, len(filenames))
+        
+    if watch:
+        directories=[path for path in paths if os.path.isdir(path)]
+        print(_('\nWatching {} for new files. Press Ctrl+C to finish.').format(', '.join(directories)))
+        file_counter=len(filenames)
+        for filename in DirectoryWatcher(directories, recursive):
+            if input_filter.accept(filename, False):
+                file_counter+=1
+                yield Job(filename, file_counter)
+                
+def run_commands(commands, process_runner=run_process):
+    """Runs the commands one after the other, stopping at the first failing one. Returns its exit code.
+    
+    """
+    for cmd in commands:
+        exit_code=process_runner(cmd)[0]
+        if exit_code:
+            return exit_code
+        
+    return 0
+
 def print_duration(seconds):
     output=''
     seconds_per_minute=60
@@ -404,48 +2209,76 @@ def print_duration(seconds):
     return output.strip()
 
     
-def ass2srt(in_filename):
-    out_filename=os.path.splitext(in_filename)[0]+'.srt'
-    in_file=open(in_filename,'r')
-    out_file=open(out_filename,'w')
+def ass_time2srt_time(ass_time):
+    """Converts an ASS/SSA timestamp (H:MM:SS.cc) to the SRT format (HH:MM:SS,mmm).
+    
+    """
+    if len(ass_time) == 10 and ass_time[1] == ':' and ass_time[7] == '.' and ass_time[8:].isdigit(): # The usual case, with no need of parsing.
+        return '0' + ass_time[:7] + ',' + ass_time[8:] + '0'
+    
+    match=ASS_TIME_REGEX.match(ass_time)
+    if not match:
+        return None
+    
+    hours,minutes,seconds,fraction=match.groups()
+    return '{:02d}:{:02d}:{:02d},{:03d}'.format(int(hours),int(minutes),int(seconds),int(fraction.ljust(3,'0')))
+
+def ass_text2srt_text(text):
+    """Removes the override tags of an ASS/SSA dialogue and converts its line breaks.
+    
+    Returns None for drawings, which have no text to show.
+    """
+    if '{' in text:
+        if ASS_DRAWING_REGEX.search(text):
+            return None
+        
+        text=ASS_TAG_REGEX.sub('',text)
+        
+    return text.replace('\\N','\n').replace('\\n','\n').replace('\\h',' ').strip()
+
+def ass2srt(in_filename, out_filename=None, encoding='utf-8'):
+    """Converts an ASS/SSA subtitle file to SRT, returning the name of the new file.
+    
+    Dialogue fields are located through the Format line of the Events section, and the
+    files are processed line by line, so the memory used does not depend on their size.
+    """
+    if not out_filename:
+        out_filename=os.path.splitext(in_filename)[0]+'.srt'
+        
+    fields=ASS_DEFAULT_EVENT_FORMAT
+    n_fields,start_index,end_index,text_index=len(fields),fields.index('start'),fields.index('end'),fields.index('text')
+    section=None
     dialog_counter=0
-    for line in in_file:
-        dialog=''
-        line=line.strip()
-        if line[:9] == 'Dialogue:':
-            dialog_counter+=1
-            fields=line[10:].split(',')
-            ftime=line[10:].split(',')[1]
-            ltime=line[10:].split(',')[2]
-            for sentence in fields[3:]:
-                dialog+=(sentence+',')
-                
-            dialog=dialog.rstrip(',')
-            ftime_hour,ftime_min,ftime_seconds=ftime.split(':')
-            ftime_hour,ftime_min=int(ftime_hour),int(ftime_min)
-            ftime_seconds,ftime_mseconds=ftime_seconds.split('.')
-            ftime_seconds,ftime_mseconds=int(ftime_seconds),int(ftime_mseconds)*10
-
-            ltime_hour,ltime_min,ltime_seconds=ltime.split(':')
-            ltime_hour,ltime_min=int(ltime_hour),int(ltime_min)
-            ltime_seconds,ltime_mseconds=ltime_seconds.split('.')
-            ltime_seconds,ltime_mseconds=int(ltime_seconds),int(ltime_mseconds)*10
-            
-            output_line="{:d}\n{:02d}:{:02d}:{:02d},{:03d} --> {:02d}:{:02d}:{:02d},{:03d}\n{}\n\n".format(dialog_counter,ftime_hour,ftime_min,ftime_seconds,ftime_mseconds,ltime_hour,ltime_min,ltime_seconds,ltime_mseconds,dialog)
-            out_file.write(output_line)
-            
-    
-    in_file.close()
-    out_file.close()
+    with open(in_filename,'r',encoding=encoding,errors='replace') as in_file, open(out_filename,'w',encoding='utf-8') as out_file:
+        for line in in_file:
+            if line[:9] == 'Dialogue:':
+                values=line[9:].split(',',n_fields-1)
+                if len(values) < n_fields:
+                    continue
+                
+                ftime=ass_time2srt_time(values[start_index])
+                ltime=ass_time2srt_time(values[end_index])
+                dialog=ass_text2srt_text(values[text_index])
+                if not ftime or not ltime or not dialog:
+                    continue
+                
+                dialog_counter+=1
+                out_file.write('{:d}\n{} --> {}\n{}\n\n'.format(dialog_counter,ftime,ltime,dialog))
+                
+            else:
+                line=line.strip().lstrip('\ufeff')
+                if line[:1] == '[':
+                    section=line.lower()
+                    
+                elif line[:7] == 'Format:' and section == '[events]':
+                    fields=[field.strip().lower() for field in line[7:].split(',')]
+                    if not {'start', 'end', 'text'}.issubset(fields):
+                        fields=ASS_DEFAULT_EVENT_FORMAT
+                        
+                    n_fields,start_index,end_index,text_index=len(fields),fields.index('start'),fields.index('end'),fields.index('text')
     
     return out_filename
 
-def dstring2dint(duration_string):
-    hours,minutes,seconds=duration_string.split(':')
-    hours,minutes,seconds=int(hours),int(minutes),int(round(float(seconds)))
-    duration_seconds=3600*hours+60*minutes+seconds
-    return duration_seconds
-
 def random_string(length = 10):
     rand_string = ''
     for letter in random.sample(string.ascii_lowercase + string.ascii_uppercase + string.digits, length):
@@ -453,59 +2286,404 @@ def random_string(length = 10):
 
     return rand_string
 
+def get_threads_per_job(threads, jobs):
+    """Split the available processor cores among the concurrent transcoding jobs.
+    
+    """
+    if jobs == 1:
+        return threads # Let ffmpeg decide when 0, as it always did.
+    
+    if not threads:
+        threads = os.cpu_count() or 1
+        
+    return max(1, threads // jobs)
+
+def get_number_of_jobs(jobs):
+    """Returns the number of concurrent jobs, 0 meaning one job per CORES_PER_JOB cores.
+    
+    """
+    if not jobs:
+        jobs = max(1, (os.cpu_count() or 1) // CORES_PER_JOB)
+        
+    return jobs
+
+def transcode_file(filename, options, media_info_cache=None, tmp_dir=None, log=None, process_runner=run_process):
+    """Transcodes a file with the given TranscodeOptions, to use this script as a module.
+    
+    Returns a TranscodeResult, or raises ProbeError, EncodeError or MuxError. Progress messages are
+    written to log (the standard output by default) and external programs are run by process_runner.
+    """
+    options_error=options.check()
+    if options_error:
+        raise TranscodeError(options_error)
+    
+    video=Video(filename, media_info_cache, tmp_dir, log, process_runner)
+    try:
+        if not video.is_ok():
+            raise ProbeError(_("File {} is not a proper video file.").format(filename))
+        
+        video.set_options(options)
+        if not video.encode():
+            raise EncodeError(_('Error transcoding file {} with ffmpeg.').format(filename))
+        
+        if not video.mux():
+            raise MuxError(_('Error creating the MKV file of {} with mkvmerge.').format(filename))
+        
+        video.remove_original()
+        return TranscodeResult(filename, video.get_output_filename(), video.get_stage_times(), video.get_encode_stats(), video.get_tool_time())
+    
+    finally:
+        video.clean()
+
+def clean_journal_leftovers(entry):
+    """Removes the files left behind by the interrupted run recorded in a journal entry.
+    
+    Returns the intermediate ffmpeg output if it was completed and can be resumed from.
+    """
+    resumable=None
+    if entry['stage'] in ['encoded', 'muxing'] and entry.get('ffmpeg_output') and os.path.isfile(entry['ffmpeg_output']): # Complete once encoded, even if muxing was interrupted.
+        resumable=entry['ffmpeg_output']
+        
+    leftovers=list(entry.get('tmp_files', []))
+    if entry.get('ffmpeg_output'):
+        leftovers+=glob.glob(glob.escape(os.path.splitext(entry['ffmpeg_output'])[0]) + '_*') # Pieces of chunked encoding.
+        
+    if entry['stage'] in ['encoding', 'encoded', 'muxing'] and entry.get('partial_output'):
+        leftovers.append(entry['partial_output']) # Incomplete final file.
+        
+    if entry['stage'] in ['encoding', 'encoded', 'muxing'] and entry.get('output') and os.path.isfile(entry['path']):
+        leftovers.append(entry['output']) # Empty, or moved into place but not recorded as done; its name can be used again. Never the only copy left.
+        
+    for leftover in leftovers:
+        if leftover != resumable and os.path.isfile(leftover):
+            print(_("Removing temporary file '{}'.").format(leftover))
+            os.remove(leftover)
+            
+    return resumable
+
+def prepare_job(job, options, reporter, media_info_cache, journal=None, tmp_dir=None):
+    """First pipeline stage: probes the file, finds its subtitles and crop dimensions.
+    
+    """
+    print(_('\n==== Preparing file {} ====').format(job.get_position()))
+    resumable=None
+    entry=journal and journal.get(job.filename)
+    if entry:
+        if entry['stage'] == 'done' and entry.get('output') and os.path.isfile(entry['output']):
+            print(_('File {} was already transcoded to {}, skipping it.').format(job.filename, entry['output']))
+            reporter.add_skipped_file(job.filename)
+            return None
+        
+        resumable=clean_journal_leftovers(entry)
+        
+    job.video=Video(job.filename, media_info_cache, tmp_dir)
+    if not job.video.is_ok():
+        sys.stderr.write(_("File {} is not a proper video file.\n").format(job.filename))
+        reporter.add_ignored_file(job.filename)
+        return None
+    
+    job.video.set_options(options)
+    if resumable:
+        job.video.resume_encoded(resumable)
+        
+    if journal:
+        journal.record(job.filename, 'prepared', tmp_files=[os.path.abspath(tmp_file) for tmp_file in job.video.get_temporary_files()], ffmpeg_output=None, output=None, partial_output=None)
+        
+    return job
+
+def release_space(job, disk_space):
+    if disk_space and job.space_reservation:
+        disk_space.release(job.space_reservation)
+        job.space_reservation=None
+
+def encode_job(job, reporter, journal=None, disk_space=None):
+    """Second pipeline stage: the actual (CPU-heavy) transcoding with ffmpeg.
+    
+    The disk space the file needs is reserved first, until it is muxed.
+    """
+    print(_('\n==== Transcoding file {} ====').format(job.get_position()))
+    if disk_space:
+        job.space_reservation=disk_space.reserve(job.video.get_space_needs())
+        if not job.space_reservation:
+            reporter.add_file_with_errors(job.filename)
+            job.video.clean()
+            if journal:
+                journal.record(job.filename, 'failed')
+                
+            return None
+        
+    if journal:
+        if job.video.is_direct_mux():
+            journal.record(job.filename, 'encoding', output=os.path.abspath(job.video.get_output_filename()), partial_output=os.path.abspath(job.video.get_partial_output_filename()))
+            
+        else:
+            journal.record(job.filename, 'encoding', ffmpeg_output=os.path.abspath(job.video.get_intermediate_filename()), output=os.path.abspath(job.video.get_output_filename()))
+        
+    if job.video.encode():
+        if journal:
+            journal.record(job.filename, 'encoded')
+            
+        return job
+    
+    reporter.add_file_with_errors(job.filename)
+    reporter.add_metrics(job.filename, job.video.get_stage_times(), job.video.get_encode_stats(), job.video.get_tool_time())
+    job.video.clean()
+    release_space(job, disk_space)
+    if journal:
+        journal.record(job.filename, 'failed')
+        
+    return None
+
+def mux_job(job, reporter, journal=None, disk_space=None):
+    """Last pipeline stage: creates the final MKV file with mkvmerge.
+    
+    """
+    if journal:
+        journal.record(job.filename, 'muxing', output=os.path.abspath(job.video.get_output_filename()), partial_output=os.path.abspath(job.video.get_partial_output_filename()))
+        
+    if job.video.mux():
+        reporter.count_file_ok()
+        if journal:
+            journal.record(job.filename, 'done')
+            
+        job.video.remove_original() # Only once recorded as done, the output would be taken as a leftover otherwise.
+        
+    else:
+        reporter.add_file_with_errors(job.filename)
+        if journal:
+            journal.record(job.filename, 'failed')
+
+    reporter.add_metrics(job.filename, job.video.get_stage_times(), job.video.get_encode_stats(), job.video.get_tool_time())
+    job.video.clean() # Always clean, not only in success, please...
+    release_space(job, disk_space)
+    print(_('==== File {} finished ====').format(job.get_position()))
+    return job
+
+def job_failed(job, error, reporter, journal=None, disk_space=None):
+    sys.stderr.write(_("ERROR: Unexpected error processing file {}: {}\n").format(job.filename, error))
+    reporter.add_file_with_errors(job.filename)
+    if job.video:
+        reporter.add_metrics(job.filename, job.video.get_stage_times(), job.video.get_encode_stats(), job.video.get_tool_time())
+        job.video.clean()
+        
+    release_space(job, disk_space)
+    if journal:
+        journal.record(job.filename, 'failed')
+
+def run_worker(job_queue, jobs, threads, media_info_cache, reporter, tmp_dir=None):
+    """Transcodes the files of a job queue, jobs of them at the same time, until all of them are finished.
+    
+    While other workers have files in progress, it keeps waiting to take them if their lease expires.
+    If the lease of a file is lost (it was given to another worker), its programs are killed and
+    its result is not recorded.
+    """
+    import socket
+    worker='{}:{:d}'.format(socket.gethostname(), os.getpid())
+    claimed={} # Process group of each file being transcoded.
+    lock=threading.Lock()
+    finished=threading.Event()
+    
+    def renew_leases():
+        while not finished.wait(LEASE_TIME / 4):
+            with lock:
+                claimed_files=list(claimed.items())
+                
+            for filename, processes in claimed_files:
+                if not job_queue.renew(filename, worker):
+                    sys.stderr.write(_("WARNING: Lease of file {} lost, it was given to another worker. Stopping it.\n").format(filename))
+                    processes.kill()
+                    
+    def work():
+        while True:
+            claim=job_queue.claim(worker)
+            if not claim:
+                if not job_queue.has_unfinished():
+                    return
+                
+                time.sleep(QUEUE_POLL_INTERVAL)
+                continue
+            
+            filename, options = claim
+            options.threads=threads
+            processes=ProcessGroup()
+            with lock:
+                claimed[filename]=processes
+                
+            print(_('\n==== Transcoding file {} (worker {}) ====').format(filename, worker))
+            try:
+                result=transcode_file(filename, options, media_info_cache, tmp_dir, process_runner=functools.partial(run_process, processes=processes))
+                if processes.is_killed():
+                    continue
+                
+                job_queue.finish(filename, worker, 'done', {'output': result.output_filename, 'stage_times': result.stage_times, 'encode_stats': result.encode_stats, 'tool_time': result.tool_time})
+                reporter.count_file_ok()
+                reporter.add_metrics(filename, result.stage_times, result.encode_stats, result.tool_time)
+                
+            except Exception as error: # Reported to the queue, not to kill the worker.
+                if processes.is_killed():
+                    continue
+                
+                sys.stderr.write(_("ERROR: {}\n").format(error))
+                job_queue.finish(filename, worker, 'failed', {'error': str(error)})
+                reporter.add_file_with_errors(filename)
+                
+            finally:
+                with lock:
+                    del claimed[filename]
+                    
+    heartbeat=threading.Thread(target=renew_leases, daemon=True)
+    heartbeat.start()
+    workers=[threading.Thread(target=work, daemon=True) for n in range(jobs)]
+    for thread in workers:
+        thread.start()
+        
+    try:
+        for thread in workers:
+            thread.join()
+            
+    finally:
+        finished.set()
+        
+def run_coordinator(job_queue, jobs, options, reporter):
+    """Puts the files of the jobs given in a job queue, waits until its workers are done with them and adds their results to reporter.
+    
+    """
+    filenames=[]
+    for job in jobs:
+        if job_queue.put(job.filename, options):
+            filenames.append(job.filename)
+            
+        else:
+            reporter.add_skipped_file(job.filename)
+            
+    print(_('{:d} file(s) added to the job queue, waiting for the workers.').format(len(filenames)))
+    n_finished=0
+    while job_queue.has_unfinished(filenames):
+        time.sleep(QUEUE_POLL_INTERVAL)
+        n=sum(1 for path, state, result in job_queue.get_states(filenames) if state in ['done', 'failed'])
+        if n != n_finished:
+            n_finished=n
+            print(_('{:d}/{:d} files finished.').format(n_finished, len(filenames)))
+            
+    reporter.add_queue_results(job_queue.get_states(filenames))
+
 def run_script():
     """Function to be called to actually run the script.
     """
+    gettext.gettext = i18n_text_argparse
+    import argparse ## Need to be imported after the previous declaration, to allow argparse text be translated.
+    
     check_the_required_programs()
     initial_time=time.time()
     parser=argparse.ArgumentParser(description=_("This program transcode video files to H264 and AAC in MKV format. Subtitles, if present, are automatically detected and soft subbed into the corresponding output files."), add_help=False)
-    parser.add_argument('video', nargs='+', help=_('Input video file(s).'))
+    parser.add_argument('video', nargs='*', help=_('Input video file(s) or directories.'))
     parser.add_argument('-h','--help', action='help', help=_("Show this help message and exit."))
-    parser.add_argument('-p', '--preset', default='medium', help=_('X264 preset [default: %(default)s].'))
-    parser.add_argument('-q','--crf', type=int, default=23, help=_('CRF value [default: %(default)s]. Determines the output video quality. Smaller values gives better qualities and bigger file sizes, bigger values result in less quality and smaller file sizes. CRF values should be in the range of 0 to 51. 0 is lossless (and with the biggest file size), 51 is worst possible quality (with the smallest file size) and 18 is visually lossless. Default value results in a nice quality/size ratio.'))
+    parser.add_argument('-e', '--encoder', default='libx264', choices=sorted(ENCODERS), help=_('Video encoder [default: %(default)s].'))
+    parser.add_argument('-p', '--preset', help=_('Encoder preset [default: medium for libx264 and libx265, 8 for libsvtav1].'))
+    parser.add_argument('-q','--crf', type=int, help=_('CRF value [default: 23 for libx264, 28 for libx265, 35 for libsvtav1]. Determines the output video quality. Smaller values gives better qualities and bigger file sizes, bigger values result in less quality and smaller file sizes. For libx264 CRF values should be in the range of 0 to 51. 0 is lossless (and with the biggest file size), 51 is worst possible quality (with the smallest file size) and 18 is visually lossless. Default value results in a nice quality/size ratio.'))
+    parser.add_argument('-b', '--bitrate', type=int, help=_('Target average video bitrate, in kbit/s. If set, it is used instead of CRF.'))
+    parser.add_argument('--two-pass', action='store_true', default=False, help=_('Two-pass encoding, for a more accurate target bitrate (-b). Not supported by libsvtav1.'))
+    parser.add_argument('--target-bitrate', type=int, help=_('Choose the CRF of each file so its video gets about this average bitrate, in kbit/s, as measured by encoding a few short samples.'))
+    parser.add_argument('--target-quality', type=float, help=_('Choose for each file the highest CRF giving at least this quality, as measured by encoding a few short samples and comparing them with the original (see --quality-metric).'))
+    parser.add_argument('--quality-metric', choices=sorted(QUALITY_FILTERS), default='ssim', help=_('Metric used by --target-quality: SSIM (0 to 1, 0.98 is usually transparent) or VMAF (0 to 100, needs ffmpeg built with libvmaf) [default: %(default)s].'))
     parser.add_argument('-r', '--replace-original-video-file', action='store_true', default=False, dest='replace', help=_('If set then original video files will be erased after transcoding. WARNING: deleted files can not be easily recovered!'))
     parser.add_argument('-l','--avlang', default='eng', help=_('Default audio language for MKV files obtained (used only if the original stream languages fail to be determined) [default: %(default)s].'))
     parser.add_argument('-L', '--slang', default='spa', help=_('Default subtitle language of soft-subbed subtitles (only used if original subtitle languages fail to be determined) [default: %(default)s].'))
     parser.add_argument('-x', '--filename-postfix', default='_h264', help=_('Postfix to be added to newly created H.264 video files [default: %(default)s].'))
     parser.add_argument('-t', '--threads', type=int, default=0, help=_('Indicates the number of processor cores the script will use. 0 indicates to use as many as possible [default: %(default)s].'))
+    parser.add_argument('-j', '--jobs', type=int, default=1, help=_('Number of files to be transcoded at the same time. The processor cores given by -t are split among them. 0 indicates one job per {:d} cores [default: %(default)s].').format(CORES_PER_JOB))
     parser.add_argument('-c', '--auto-crop', action='store_true', default=False, help=_('Turn on autocrop function. WARNING: Use with caution as some video files has variable width horizontal (and vertical) black bars, in those cases you will probably lose data.')) 
+    parser.add_argument('--crop-samples', type=int, default=20, help=_('Number of evenly spaced points of the video checked by the autocrop function [default: %(default)s].'))
+    parser.add_argument('--srt', action='store_true', default=False, help=_('Convert ASS/SSA subtitles to SRT, for players not supporting them. Original external subtitle files are kept.'))
+    parser.add_argument('-R', '--recursive', action='store_true', default=False, help=_('Look for input files also in the subdirectories of the directories given.'))
+    parser.add_argument('--extensions', default=','.join(VIDEO_EXTENSIONS), help=_('Comma separated list of extensions of the files to be transcoded in the input directories, other files are ignored without probing them. An empty value accepts any extension. Files given explicitly are always tried [default: %(default)s].'))
+    parser.add_argument('--min-size', type=float, default=0, help=_('Ignore, without probing them, files in the input directories smaller than this size, in MB [default: %(default)s].'))
+    parser.add_argument('-f', '--force', action='store_true', default=False, help=_('Transcode the files in the input directories even if their output file already exists. Files given explicitly are always transcoded, to a new output file if needed.'))
+    parser.add_argument('--dedup', action='store_true', default=False, help=_('Skip input files with the same content (size, beginning and end) as another input file.'))
+    parser.add_argument('-w', '--watch', action='store_true', default=False, help=_('After transcoding the given files, keep watching the given directories and transcode the new files arriving to them.'))
+    parser.add_argument('-d', '--direct-mux', action='store_true', default=False, help=_('Write the final MKV file (subtitles included) directly with ffmpeg, without an intermediate file nor a mkvmerge step. Saves a full write and read of every video.'))
+    parser.add_argument('-s', '--smart-copy', action='store_true', default=False, help=_('Copy, instead of transcoding, the video streams already in the codec of the encoder (H.264 for libx264) and the audio streams already in AAC. Video streams are always transcoded if they need to be cropped.'))
+    parser.add_argument('-k', '--chunks', type=int, default=0, help=_('Split the video of each file in this number of pieces, to be encoded in parallel and then joined. Useful to use many processor cores with a few long videos. 0 or 1 turns it off [default: %(default)s].'))
+    parser.add_argument('--tmpdir', help=_('Directory for the intermediate files (ffmpeg output, extracted subtitles) [default: the directory of each input file]. The final MKV file is always written in the directory of its input file, under a temporary name until it is complete.'))
+    parser.add_argument('--no-space-check', action='store_true', default=False, help=_('Do not check, before transcoding each file, that there is enough free disk space for it.'))
+    parser.add_argument('--queue', help=_('Job queue (a SQLite database in storage shared with the workers) where the input files are put, instead of transcoding them. Then waits until the workers are done with them and reports the results of all of them. Input files must be at the same path in all the hosts.'))
+    parser.add_argument('--worker', metavar='QUEUE', help=_('Transcode the files of this job queue, with the options given to the coordinator, until all of them are finished. Several workers, in this and other hosts, can share a queue. Only -j, -t, --tmpdir and the cache options are taken from the command line of the worker.'))
+    parser.add_argument('--journal', help=_('File where the progress of every video is recorded. Running again with the same journal skips the files already transcoded, resumes the unfinished ones and removes their leftover temporary files.'))
+    parser.add_argument('--metrics', help=_('Write to this file, in JSON format, the time spent in each stage and the encoding statistics of every video.'))
+    parser.add_argument('--cache-dir', default=get_default_cache_dir(), help=_('Directory where the information about already probed files is kept [default: %(default)s].'))
+    parser.add_argument('--no-cache', action='store_true', default=False, help=_('Always probe the files, without using nor updating the cache.'))
     parser.add_argument('-v', '--version', action='version', version='3.2.6', help=_("Show program's version number and exit.")) # I need to use this explicit help message here (together with setting add_help=False when creating the parser) to be able to proper translate the version help message (when required). All other messages are translated OK, but not this one. With this edit now everything is OK.
     
     args=parser.parse_args()
 
-    if args.crf < 0 or args.crf > 51:
-        parser.error(_('CRF values should be in the range of 0 to 51.'))
+    if not args.video and not args.worker:
+        parser.error(_('The following arguments are required: video'))
+
+    if args.queue and args.worker:
+        parser.error(_('Options --queue and --worker can not be used together.'))
+
+    if args.watch and (args.queue or args.worker):
+        parser.error(_('Watch mode can not be used with a job queue.'))
+
+    if args.journal and (args.queue or args.worker):
+        parser.error(_('The job queue already keeps the progress of every file, --journal can not be used with it.'))
+
+    if args.jobs < 0:
+        parser.error(_('The number of jobs must be 0 or positive.'))
+
+    options=TranscodeOptions.from_args(args)
+    options_error=options.check()
+    if options_error:
+        parser.error(options_error)
+
+    media_info_cache=None
+    if not args.no_cache:
+        media_info_cache=MediaInfoCache(args.cache_dir)
         
-    if args.threads < 0:
-        parser.error(_('The number of threads must be 0 or positive.'))
+    if args.target_quality and args.quality_metric == 'vmaf' and not has_ffmpeg_filter('libvmaf', media_info_cache):
+        parser.error(_('Your ffmpeg does not support VMAF (libvmaf filter).'))
+
+    if args.watch and not any(os.path.isdir(path) for path in args.video):
+        parser.error(_('Watch mode needs at least one input directory.'))
 
-    known_presets = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow", "placebo"]
-    if args.preset not in known_presets:
-        parser.error(_('Unknown preset "{}".\nValid values are:\n\t{}\n').format(args.preset, '\n\t'.join(known_presets)))
+    if args.tmpdir and not (os.path.isdir(args.tmpdir) and os.access(args.tmpdir, os.W_OK)):
+        parser.error(_('The temporary directory {} does not exist or is not writable.').format(args.tmpdir))
 
+    jobs=get_number_of_jobs(args.jobs)
+    options.threads=get_threads_per_job(args.threads, jobs) # Cores of each job.
     reporter=Reporter()
-    file_counter=0
-    for filename in args.video:
-        file_counter+=1        
-        print(_('\n==== Transcoding file {:d}/{:d} ====').format(file_counter,len(args.video)))
-        video=Video(filename)
-        if not video.is_ok():
-            sys.stderr.write(_("File {} is not a proper video file.\n").format(filename))
-            reporter.add_ignored_file(filename)
-            continue
+    journal=None
+    if args.journal:
+        journal=Journal(args.journal)
         
-        video.set_transcoding_options(args.preset, args.crf, args.replace, args.avlang, args.slang, args.filename_postfix, args.threads, args.auto_crop)
-        if video.transcode():
-            reporter.count_file_ok()
+    disk_space=None
+    if not args.no_space_check:
+        disk_space=DiskSpace()
+        
+    pipeline=Pipeline(queue_size=jobs, error_handler=functools.partial(job_failed, reporter=reporter, journal=journal, disk_space=disk_space))
+    pipeline.add_stage(functools.partial(prepare_job, options=options, reporter=reporter, media_info_cache=media_info_cache, journal=journal, tmp_dir=args.tmpdir))
+    pipeline.add_stage(functools.partial(encode_job, reporter=reporter, journal=journal, disk_space=disk_space), workers=jobs)
+    pipeline.add_stage(functools.partial(mux_job, reporter=reporter, journal=journal, disk_space=disk_space))
+    input_filter=InputFilter(args.extensions.split(','), args.min_size * 1024 * 1024, args.filename_postfix, args.force, args.dedup, reporter)
+    try:
+        if args.worker:
+            run_worker(JobQueue(args.worker), jobs, options.threads, media_info_cache, reporter, args.tmpdir)
             
-        else:
-            reporter.add_file_with_errors(filename)
-
-        video.clean() # Always clean, not only in success, please...
+        elif args.queue:
+            run_coordinator(JobQueue(args.queue), generate_jobs(args.video, input_filter, args.recursive, args.watch), options, reporter)
             
-        print(75*'=')
+        else:
+            pipeline.run(generate_jobs(args.video, input_filter, args.recursive, args.watch))
+        
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+        
+        sys.stderr.write(_('\nInterrupted, files being transcoded are left unfinished.\n'))
             
     reporter.print_final_report()
+    if args.metrics:
+        reporter.write_metrics(args.metrics, dict((tool, get_tool_version(tool, media_info_cache)) for tool in TOOLS))
         
     final_time=time.time()
     